@@ -4,11 +4,12 @@ import sys
 import argparse
 import logging
 from subprocess import run, CalledProcessError
+from contextlib import closing
 import concurrent.futures
 logger = logging.getLogger()
 from pathlib import Path
 
-from yaml import load, dump
+from yaml import load_all, dump
 try:
     from yaml import CLoader as Loader, CDumper as Dumper
 except ImportError:
@@ -99,6 +100,14 @@ class StatusPrinter:
 
         sys.stdout.flush()
 
+    def done(self):
+        """End the status lines, so that what is printed next starts on a
+        line of its own."""
+        if self.msg:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+            self.msg = {}
+
 
 # Obsolete
 def check_empty_items(base_tree):
@@ -152,18 +161,67 @@ def breadcrumb(dict_or_list, value):
             if p and p.get("n") is not None:
                 return p.get("n")
 
+def load_compact(fpath, layout, csum_name, names):
+    """Load a YAML file of any layout into a CompactTree, as a stream."""
+    from sdc_detector.manifest import iter_manifest
+    from sdc_detector.compact import CompactTree
+    return CompactTree.from_records(iter_manifest(fpath, layout),
+                                    csum_name, names)
+
 # @timer
 def load_yaml(fpath):
-    with open(fpath, 'r') as fp:
-        return load(fp, Loader=Loader)
+    from sdc_detector.compress import open_read
+    # Compressed files are detected from their magic bytes
+    with open_read(fpath) as fp:
+        # The tree is the last document, after the optional header
+        *_, tree = load_all(fp, Loader=Loader)
+        return tree
+
+def filter_rule(rule):
+    """Type of the --exclude and --include patterns."""
+    from sdc_detector.filters import rule_error
+    error = rule_error(rule)
+    if error is not None:
+        raise argparse.ArgumentTypeError(f"invalid pattern {rule!r}: {error}")
+    return rule
+
+def print_duplicates(label, records):
+    """Print groups of files sharing the same content within one tree."""
+    from sdc_detector.index import find_duplicates
+    for paths in find_duplicates(records):
+        print(f"Duplicate content in {label}: {', '.join(paths)}")
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    # The log level is read first, so that the messages logged while the
+    # sdc_detector modules are imported are not lost
+    log_parser = argparse.ArgumentParser(add_help=False)
+    levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+    log_parser.add_argument('--log', action='store', default="WARNING",
+        choices=levels,
+        help='Log level. [DEBUG, INFO, WARNING, ERROR, CRITICAL]')
+    log_args, _ = log_parser.parse_known_args()
+
+    log_level = getattr(logging, log_args.log.upper(), None)
+    if not isinstance(log_level, int):
+        raise ValueError(f'Invalid log level: {log_args.log}')
+    logger.setLevel(log_level)
+    conhandler = logging.StreamHandler()
+    conhandler.setLevel(log_level)
+    logger.addHandler(conhandler)
+
+    from sdc_detector.compress import COMPRESSIONS, HAS_ZSTD
+    from sdc_detector.csum import SMALL_FILE_SIZE, HAS_XXHASH
+    from sdc_detector.remote import is_address, BLOCK_SIZE, MIN_BLOCK_SIZE
+    from sdc_detector.filters import IGNORE_FILE
+
+    parser = argparse.ArgumentParser(parents=[log_parser])
     parser.add_argument('path1', type=str,
-        help='Path to directory to scan for files, or path to output file.')
+        help='Path to directory to scan for files, or path to output file, '
+             'or address of an agent (tcp://host:port, unix:///path).')
     parser.add_argument('path2', type=str, default=None, nargs='?',
-        help='Path to directory to scan for files, or path to output file.')
+        help='Path to directory to scan for files, or path to output file, '
+             'or address of an agent (tcp://host:port, unix:///path).')
     parser.add_argument('--output_dir', default="./", type=str,\
             help="Output directory where to write results.")
     parser.add_argument('-n', '--no_output', action='store_true',\
@@ -174,71 +232,229 @@ if __name__ == "__main__":
         choices=hashes,
         help='hash or crc algorithm to use for integrity checking.',
         required=False)
-    levels = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
-    parser.add_argument('--log', action='store', default="WARNING",
-        choices=levels,
-        help='Log level. [DEBUG, INFO, WARNING, ERROR, CRITICAL]')
-    implementations = ('pure_dict', 'mixed_dict', 'pure_list')
+    parser.add_argument('--front_coded', action='store_true',
+        help='Write YAML result files as a list of files sorted by path, each '
+             'path only storing what differs from the previous one. '
+             'These can only be compared with the "compact" tree type.')
+    parser.add_argument('--compress', action='store', default='none',
+        choices=COMPRESSIONS,
+        help='Compress the YAML result files. Compressed files are detected '
+             'automatically when read. Default "none".')
+    implementations = ('pure_dict', 'mixed_dict', 'pure_list', 'compact')
     parser.add_argument('--tree_type', action='store', default='mixed_dict',
         choices=implementations,
         help=f'Tree representation implementation to use. Default "mixed_dict".')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='Number of processes comparing top level subtrees in parallel. '
+             'Default is the number of CPUs.')
+    parser.add_argument('--watch', action='store_true',
+        help='Keep watching path1 with inotify (Linux only), and keep its '
+             'YAML result file up to date by hashing again only the files '
+             'written since. path2 may be a previous result file to start '
+             'from.')
+    parser.add_argument('--interval', type=int, default=300,
+        help='Seconds between two updates of the watched result file. '
+             'Default 300.')
+    parser.add_argument('--scrub', type=int, default=1000,
+        help='Number of files not written since the last update hashed '
+             'again at each update when watching. Their checksum is not '
+             'expected to change. Default 1000.')
+    parser.add_argument('--reflinks', action='store_true',
+        help='Also hash only once the data of files sharing all their '
+             'extents (reflinked clones), as reported by FIEMAP. Hardlinks '
+             'are always hashed once, unless smaller than --small_file_size.')
+    parser.add_argument('--small_file_size', type=int, default=SMALL_FILE_SIZE,
+        help='Files smaller than this many bytes are read with a single call '
+             f'and hashed at once. 0 disables it. Default {SMALL_FILE_SIZE}.')
+    parser.add_argument('--threads', type=int, default=min(8, os.cpu_count() or 1),
+        help='Number of threads hashing the files of large directories for '
+             'each tree. Default is the number of CPUs, up to 8.')
+    parser.add_argument('--serve', action='store', default=None,
+        metavar='ADDRESS',
+        help='Run as an agent answering comparisons about path1, listening '
+             'on ADDRESS (tcp://host:port or unix:///path/to/socket). Only '
+             'records and hashes are sent, never file data. Without --token, '
+             'only a loopback address or a Unix socket is accepted.')
+    parser.add_argument('--token', action='store',
+        default=os.environ.get('SDC_TOKEN'),
+        help='Secret shared by agents and comparisons: agents refuse '
+             'connections without it. Defaults to the SDC_TOKEN environment '
+             'variable, which keeps it out of the process list. It is sent '
+             'in clear text: use it on trusted networks or through an SSH '
+             'tunnel.')
+    parser.add_argument('--min_block_size', type=int, default=MIN_BLOCK_SIZE,
+        help='Smallest --block_size an agent accepts, since the checksums of '
+             'small blocks would give away their content. '
+             f'Default {MIN_BLOCK_SIZE >> 10} KiB.')
+    parser.add_argument('--block_size', type=int, default=BLOCK_SIZE,
+        help='When comparing through agents, files changed in place are '
+             'hashed again in blocks of this many bytes on both sides, to '
+             'locate the differences. 0 disables it. '
+             f'Default {BLOCK_SIZE >> 10} KiB.')
+    parser.add_argument('--exclude', action='append', default=[],
+        type=filter_rule, metavar='PATTERN',
+        help='Skip files and directories matching PATTERN: a glob matched '
+             'against names, or against paths relative to the scanned '
+             'directory if it holds a "/", or a regular expression searched '
+             'in relative paths if prefixed with "re:". Excluded directories '
+             'are not walked. May be repeated.')
+    parser.add_argument('--include', action='append', default=[],
+        type=filter_rule, metavar='PATTERN',
+        help='Only hash files matching PATTERN, with the same syntax as '
+             '--exclude. May be repeated.')
+    parser.add_argument('--ignore_file', action='store', default=IGNORE_FILE,
+        help='Name of the files holding --exclude patterns for the directory '
+             f'they are in, one per line. Default "{IGNORE_FILE}".')
+    parser.add_argument('--duplicates', action='store_true',
+        help='Also report files with identical content within each tree.')
     args = parser.parse_args()
 
-    log_level = getattr(logging, args.log.upper(), None)
-    if not isinstance(log_level, int):
-        raise ValueError(f'Invalid log level: {args.log}')
-    logger.setLevel(log_level)
-    conhandler = logging.StreamHandler()
-    conhandler.setLevel(log_level)
-    logger.addHandler(conhandler)
-
     from sdc_detector.tree import DirTreeGeneratorMixed, \
         DirTreeGeneratorPureDict, \
-        DirTreeGeneratorPureList
+        DirTreeGeneratorPureList, \
+        DirTreeGeneratorCompact
 
     from sdc_detector.diff import get_comparison
-    from sdc_detector.csum import HAS_XXHASH
+    from sdc_detector.manifest import iter_tree_records, read_header, \
+        iter_manifest
+    from sdc_detector.compact import guess_csum
+    from sdc_detector.names import NameTable
 
     if args.csum_name == 'xxhash' and not HAS_XXHASH:
         args.csum_name = 'sha1'
         logger.warning(f"'xxhash' module not found. \
 Defaulting back to {args.csum_name}.")
 
+    if args.compress == 'zstd' and not HAS_ZSTD:
+        args.compress = 'xz'
+        logger.warning(f"'zstandard' module not found. \
+Defaulting back to {args.compress}.")
+
     if args.tree_type == 'mixed_dict':
         fs_struct_type = DirTreeGeneratorMixed
     elif args.tree_type == 'pure_list':
         fs_struct_type = DirTreeGeneratorPureList
+    elif args.tree_type == 'compact':
+        fs_struct_type = DirTreeGeneratorCompact
     else:
         fs_struct_type = DirTreeGeneratorPureDict
 
-    # TODO write tree type to yaml to avoid comparing different types of trees?
-    # for now we assume the same underlying type was generated across scans.
+    # Names shared by both trees are only stored once
+    names = NameTable()
 
     # TODO
     # * write to file in chunks (buffered, sadly not possible due to the need to
     # serialize python objects into json or yaml)
     # * don't keep everything in memory, use iterators / generators
 
+    if args.watch:
+        from sdc_detector.watch import TreeWatcher
+        TreeWatcher(Path(args.path1), args, manifest=args.path2).run()
+        exit(0)
+
     printer = StatusPrinter()
 
+    if args.serve:
+        from sdc_detector.remote import ScanAgent, serve
+        try:
+            serve(args.serve, ScanAgent(Path(args.path1), args, printer),
+                  args.token)
+        except KeyboardInterrupt:
+            pass
+        except (ValueError, OSError) as e:
+            logger.critical(f"\n{e}")
+            exit(1)
+        exit(0)
+
+    if args.path2 and any(map(is_address, (args.path1, args.path2))):
+        # Each side is scanned by an agent, only differing subtrees are listed
+        from sdc_detector.remote import ScanAgent, AgentClient, \
+            RemoteComparison
+        try:
+            agents = [AgentClient(p, args.token) if is_address(p)
+                      else ScanAgent(Path(p), args, printer)
+                      for p in (args.path1, args.path2)]
+            if not RemoteComparison(*agents, args.block_size).compare():
+                print("\nNo difference found. All is good.\n")
+        except (ValueError, OSError) as e:
+            logger.critical(f"\n{e}")
+            exit(1)
+        exit(0)
+
     if not args.path2:
-        gen = fs_struct_type(Path(args.path1), args, printer)
-        gen.generate(no_output=args.no_output)
+        gen = fs_struct_type(Path(args.path1), args, printer, names)
+        tree_struct = gen.generate(no_output=args.no_output)
+        printer.done()
+        if args.duplicates:
+            print_duplicates(args.path1,
+                             iter_tree_records(tree_struct, args.tree_type))
         exit(0)
 
     args_set = (args.path1, args.path2)
 
+    # Files written without a header are assumed to match --tree_type
+    headers = {}
+    for path_str in args_set:
+        if Path(path_str).is_dir():
+            continue
+        header = headers[path_str] = read_header(path_str) or {}
+        layout = header.get('layout', args.tree_type)
+        if 'csum' not in header:
+            # Written without a header: guessed from the checksum lengths
+            with closing(iter_manifest(path_str, layout
+                    if layout != 'compact' else 'mixed_dict')) as records:
+                csum_name = guess_csum(records)
+            if csum_name is not None:
+                header['csum'] = csum_name
+        if args.tree_type != 'compact' and layout != args.tree_type:
+            # front_coded files can only be loaded as compact trees
+            hint = "--tree_type compact" if layout == 'front_coded' \
+                else f"--tree_type {layout} or --tree_type compact"
+            logger.critical(f"{path_str} holds a \"{layout}\" tree, it cannot "
+                            f"be compared as \"{args.tree_type}\". Try "
+                            f"{hint}.")
+            exit(1)
+
+    # Both sides must be hashed with the same algorithm, directories are
+    # scanned with the one recorded in the result file if there is one
+    csums = {p: h['csum'] for p, h in headers.items() if 'csum' in h}
+    if len(set(csums.values())) > 1:
+        logger.critical(f"\n{args.path1} was hashed with "
+                        f"{csums[args.path1]} and {args.path2} with "
+                        f"{csums[args.path2]}, they cannot be compared.")
+        exit(1)
+    for path_str, csum_name in csums.items():
+        if csum_name == args.csum_name:
+            break
+        if csum_name == 'xxhash' and not HAS_XXHASH \
+                and any(Path(p).is_dir() for p in args_set):
+            logger.critical(f"\n{path_str} was hashed with xxhash, but the "
+                            f"'xxhash' module is not found.")
+            exit(1)
+        logger.warning(f"\n{path_str} was hashed with {csum_name}, using it "
+                       f"instead of {args.csum_name}.")
+        args.csum_name = csum_name
+        break
+
     # executor = concurrent.futures.ProcessPoolExecutor()
     # Only threads work for sharing a common printer.
     executor = concurrent.futures.ThreadPoolExecutor()
     queue = []
+    gens = {}
 
     for path_str in args_set:
         path = Path(path_str)
         if path.is_dir():
             # Generate yaml tree file
-            gen = fs_struct_type(path, args, printer)
+            gen = gens[path_str] = fs_struct_type(path, args, printer, names)
             future = executor.submit(gen.generate, no_output=args.no_output)
+        elif args.tree_type == 'compact':
+            # Stream a yaml tree file of any layout into compact storage
+            header = headers[path_str]
+            layout = header.get('layout', 'mixed_dict')
+            future = executor.submit(load_compact, path,
+                layout if layout != 'compact' else 'mixed_dict',
+                header.get('csum', args.csum_name), names)
         else:
             # Load a yaml tree file
             future = executor.submit(load_yaml, path)
@@ -248,19 +464,35 @@ Defaulting back to {args.csum_name}.")
     for future in queue:
         results.append(future.result())
     executor.shutdown()
-
-    for tree_struct in results:
-        logger.debug(f"Dump of generate() output:")
-        logger.debug(dump(tree_struct, stream=None, Dumper=Dumper))
-    if logger.isEnabledFor(logging.DEBUG):
+    printer.done()
+
+    # Both trees leave out what either tree was scanned without
+    filters = [gens[p].path_filter.header() if p in gens
+               else headers[p].get('filters') for p in args_set]
+    if filters[0] != filters[1]:
+        from sdc_detector.filters import PathFilter, excluded_by_any, \
+            prune_tree
+        excluded = excluded_by_any(PathFilter.from_header(f) for f in filters)
+        results = [prune_tree(tree_struct, args.tree_type, excluded)
+                   for tree_struct in results]
+
+    if logger.isEnabledFor(logging.DEBUG) and args.tree_type != 'compact':
+        for tree_struct in results:
+            logger.debug(f"Dump of generate() output:")
+            logger.debug(dump(tree_struct, stream=None, Dumper=Dumper))
         for tree_struct in results:
             logger.debug(f"PPrint of dictionaries:")
             logger.debug(pprint.pformat(tree_struct))
 
+    if args.duplicates:
+        for path_str, tree_struct in zip(args_set, results):
+            print_duplicates(path_str,
+                             iter_tree_records(tree_struct, args.tree_type))
+
     # TODO extra option: for each file listed in yaml, compare with a target
     # dir (partial backups) only those files.
     # HACK always place first argument passed to the left hand side
-    if not get_comparison(fs_struct_type).compare(
+    if not get_comparison(fs_struct_type, args.jobs).compare(
         results[args_set.index(args.path1)],
         results[args_set.index(args.path2)],
         ):
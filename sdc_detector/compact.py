@@ -0,0 +1,221 @@
+import os
+import logging
+logger = logging.getLogger()
+from array import array
+
+from yaml import emit
+from yaml.events import (StreamStartEvent, StreamEndEvent,
+                         DocumentStartEvent, DocumentEndEvent,
+                         MappingStartEvent, MappingEndEvent,
+                         SequenceStartEvent, SequenceEndEvent,
+                         ScalarEvent)
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+from .manifest import FileRecord, str_event
+from .names import NameTable
+
+# Bytes of raw digest stored per file, for each checksum algorithm
+DIGEST_SIZES = {
+    'crc32': 4,
+    'xxhash': 8,
+    'md5': 16,
+    'sha1': 20,
+    'sha256': 32,
+    'blake2b': 64,
+}
+
+ROOT = -1  # parent of the entries at the top of the tree
+DIR_SIZE = -1  # size of directory entries
+
+
+def guess_csum(records):
+    """
+    Return the name of the checksum algorithm matching the length of the
+    first checksum of records, for manifests written without a header, or
+    None if there is no checksum.
+    """
+    for record in records:
+        if not isinstance(record.checksum, str):
+            continue
+        # crc32 checksums are not zero padded
+        if len(record.checksum) <= 2 * DIGEST_SIZES['crc32']:
+            return 'crc32'
+        for csum_name, size in DIGEST_SIZES.items():
+            if 2 * size == len(record.checksum):
+                return csum_name
+        return None
+    return None
+
+
+class CompactTree:
+    """
+    Columnar tree representation: entry i is described by name_ids[i],
+    parents[i] and sizes[i], and its raw digest is stored at
+    digests[i * width:(i + 1) * width]. Directory entries have a size of -1
+    and an empty digest. Entries are appended in depth-first order, so that
+    the content of a directory is contiguous and follows it.
+    Full paths are only rebuilt on demand.
+    """
+    __slots__ = ('csum_name', 'width', 'names',
+                 'name_ids', 'parents', 'sizes', 'digests', 'unreadable')
+
+    def __init__(self, csum_name='sha1', names=None):
+        self.csum_name = csum_name
+        self.width = DIGEST_SIZES[csum_name]
+        # May be shared with other trees, so that name ids can be compared
+        self.names = names if names is not None else NameTable()
+        self.name_ids = array('I')
+        self.parents = array('i')
+        self.sizes = array('q')
+        self.digests = bytearray()
+        self.unreadable = set()  # entries whose checksum is the 0 placeholder
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add_dir(self, parent, name):
+        """Append a directory entry and return its index."""
+        self.name_ids.append(self.names.id(name))
+        self.parents.append(parent)
+        self.sizes.append(DIR_SIZE)
+        self.digests.extend(bytes(self.width))
+        return len(self.sizes) - 1
+
+    def add_file(self, parent, name, size, checksum):
+        """Append a file entry with its hex checksum and return its index."""
+        self.name_ids.append(self.names.id(name))
+        self.parents.append(parent)
+        self.sizes.append(size)
+        if not checksum and not isinstance(checksum, str):
+            self.unreadable.add(len(self.sizes) - 1)
+            self.digests.extend(bytes(self.width))
+        else:
+            try:
+                digest = int(checksum, 16).to_bytes(self.width, 'big')
+            except OverflowError:
+                raise ValueError(f"Checksum {checksum} of {name} is longer "
+                                 f"than {self.csum_name} digests, pass the "
+                                 f"algorithm it was computed with to -c.")
+            self.digests.extend(digest)
+        return len(self.sizes) - 1
+
+    def name(self, i):
+        return self.names.name(self.name_ids[i])
+
+    def checksum(self, i):
+        """Return the hex checksum of entry i, as computed by csum."""
+        if i in self.unreadable:
+            return 0
+        digest = self.digests[i * self.width:(i + 1) * self.width]
+        if self.csum_name == 'crc32':
+            return f"{int.from_bytes(digest, 'big'):x}"
+        return digest.hex()
+
+    def path(self, i):
+        """Rebuild the path of entry i, relative to the root."""
+        parts = []
+        while i != ROOT:
+            parts.append(self.name(i))
+            i = self.parents[i]
+        return os.sep.join(reversed(parts))
+
+    def records(self):
+        """Yield a FileRecord for each file, in tree order."""
+        dir_paths = {ROOT: ""}
+        for i, size in enumerate(self.sizes):
+            prefix = dir_paths[self.parents[i]]
+            if size == DIR_SIZE:
+                dir_paths[i] = prefix + self.name(i) + os.sep
+            else:
+                yield FileRecord(prefix + self.name(i), size, self.checksum(i))
+
+    def file_keys(self, dir_ids, name_ids=None):
+        """
+        Yield (key, index) for each file. Keys are (directory id, name id)
+        pairs, with directory ids assigned in dir_ids, which maps
+        (parent directory id, name id) -> directory id. Two trees sharing
+        dir_ids and a NameTable give equal keys to equal paths, so that
+        paths are compared without being rebuilt.
+        name_ids optionally translates the name ids of this tree, when it
+        does not share the NameTable of the other tree.
+        """
+        dirs = {ROOT: ROOT}  # entry index -> directory id
+        for i, size in enumerate(self.sizes):
+            name_id = self.name_ids[i]
+            if name_ids is not None:
+                name_id = name_ids[name_id]
+            key = (dirs[self.parents[i]], name_id)
+            if size == DIR_SIZE:
+                dirs[i] = dir_ids.setdefault(key, len(dir_ids))
+            else:
+                yield key, i
+
+    @classmethod
+    def from_records(cls, records, csum_name='sha1', names=None):
+        """Build a tree from records listing the content of each directory
+        contiguously, like the manifest readers do."""
+        tree = cls(csum_name, names)
+        stack = []  # [(dirname, index)] of the directory being filled
+        for record in records:
+            *dirs, name = record.path.split(os.sep)
+            common = 0
+            while common < min(len(dirs), len(stack)) \
+                    and stack[common][0] == dirs[common]:
+                common += 1
+            del stack[common:]
+            for d in dirs[common:]:
+                parent = stack[-1][1] if stack else ROOT
+                stack.append((d, tree.add_dir(parent, d)))
+            parent = stack[-1][1] if stack else ROOT
+            tree.add_file(parent, name, record.size, record.checksum)
+        return tree
+
+    def dump(self, stream):
+        """Write the tree to stream in the mixed_dict YAML layout, without
+        building the nested structure."""
+        emit(self._events(), stream=stream, Dumper=Dumper)
+
+    def _events(self):
+        yield StreamStartEvent()
+        yield DocumentStartEvent(explicit=True)
+        yield MappingStartEvent(None, None, True)
+        yield ScalarEvent(None, None, (True, True), 'root')
+        yield SequenceStartEvent(None, None, True)
+
+        open_dirs = [ROOT]
+        for i, size in enumerate(self.sizes):
+            # Close the directories this entry is not part of
+            while open_dirs[-1] != self.parents[i]:
+                open_dirs.pop()
+                yield SequenceEndEvent()
+                yield MappingEndEvent()
+
+            yield MappingStartEvent(None, None, True)
+            if size == DIR_SIZE:
+                yield str_event(self.name(i))
+                yield SequenceStartEvent(None, None, True)
+                open_dirs.append(i)
+                continue
+            checksum = self.checksum(i)
+            yield ScalarEvent(None, None, (True, True), 'cs')
+            if isinstance(checksum, int):
+                yield ScalarEvent(None, None, (True, False), str(checksum))
+            else:
+                yield str_event(checksum)
+            yield ScalarEvent(None, None, (True, True), 'n')
+            yield str_event(self.name(i))
+            yield ScalarEvent(None, None, (True, True), 'sz')
+            yield ScalarEvent(None, None, (True, False), str(size))
+            yield MappingEndEvent()
+
+        for _ in open_dirs[1:]:
+            yield SequenceEndEvent()
+            yield MappingEndEvent()
+        yield SequenceEndEvent()
+        yield MappingEndEvent()
+        yield DocumentEndEvent()
+        yield StreamEndEvent()
+
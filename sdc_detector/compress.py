@@ -0,0 +1,134 @@
+import io
+import os
+import gzip
+import lzma
+import logging
+logger = logging.getLogger()
+import queue
+import threading
+
+HAS_ZSTD = False
+try:
+    import zstandard
+    HAS_ZSTD = True
+except Exception as e:
+    logger.debug(f"Failed to load zstandard module. {e}")
+
+COMPRESSIONS = ('none', 'gzip', 'xz', 'zstd')
+EXTENSIONS = {
+    'gzip': '.gz',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'xz': b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+
+CHUNK_SIZE = 1 << 20  # decompressed bytes handed over to the parser at once
+QUEUE_DEPTH = 8  # chunks decompressed ahead of the parser
+
+
+def detect_compression(fpath):
+    """Guess compression of an existing file from its magic bytes,
+    falling back to its extension."""
+    with open(fpath, 'rb') as fp:
+        head = fp.read(max(len(m) for m in MAGIC.values()))
+    for name, magic in MAGIC.items():
+        if head.startswith(magic):
+            return name
+    ext = os.path.splitext(str(fpath))[1]
+    for name, _ext in EXTENSIONS.items():
+        if ext == _ext:
+            return name
+    return 'none'
+
+
+def open_write(fpath, compression='none'):
+    """Return a text stream writing to fpath through the compressor."""
+    if compression == 'gzip':
+        return gzip.open(fpath, 'wt', encoding='utf-8')
+    elif compression == 'xz':
+        return lzma.open(fpath, 'wt', encoding='utf-8')
+    elif compression == 'zstd':
+        return zstandard.open(fpath, 'wt', encoding='utf-8')
+    return open(fpath, 'w')
+
+
+def open_read(fpath):
+    """
+    Return a binary stream of the decompressed content of fpath.
+    Compressed files are decompressed ahead in a separate thread, so that
+    decompression overlaps with parsing.
+    """
+    compression = detect_compression(fpath)
+    logger.debug(f"Reading {fpath} with compression: {compression}")
+    if compression == 'gzip':
+        fp = gzip.open(fpath, 'rb')
+    elif compression == 'xz':
+        fp = lzma.open(fpath, 'rb')
+    elif compression == 'zstd':
+        if not HAS_ZSTD:
+            raise RuntimeError(f"'zstandard' module is required to read {fpath}.")
+        fp = zstandard.open(fpath, 'rb')
+    else:
+        return open(fpath, 'rb')
+    return io.BufferedReader(PrefetchReader(fp), buffer_size=CHUNK_SIZE)
+
+
+class PrefetchReader(io.RawIOBase):
+    """Raw stream fed by a thread reading chunks from another stream."""
+    def __init__(self, fp):
+        self._fp = fp
+        self._queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b"")
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                data = self._fp.read(CHUNK_SIZE)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Don't block forever if the reader went away
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._chunk:
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._fp.close()
+        super().close()
@@ -1,3 +1,4 @@
+import os
 import logging
 logger = logging.getLogger()
 import functools
@@ -23,6 +24,7 @@ except Exception as e:
     logger.debug(f"Failed to load xxhash module. {e}")
 
 BUF_SIZE = 65536  # arbitrary value of 64kb chunks
+SMALL_FILE_SIZE = 4096  # files below this size are read in a single call
 
 
 def timer(func):
@@ -37,6 +39,47 @@ def timer(func):
         return value
     return wrapper_timer
 
+def get_csum_func(csum_name):
+    """Return the function computing the checksum of a file for csum_name."""
+    if csum_name == 'crc32':
+        return get_crc32
+    elif csum_name == 'xxhash':
+        return get_xxhash
+    return functools.partial(get_hash, hashtype=csum_name)
+
+def get_digest_func(csum_name):
+    """Return the function computing the checksum of a buffer for csum_name,
+    formatted like the ones of get_csum_func()."""
+    if csum_name == 'crc32':
+        def digest(data):
+            return f"{crc32(data):x}"
+    elif csum_name == 'xxhash':
+        def digest(data):
+            return xxh64(data).hexdigest()
+    else:
+        def digest(data):
+            return new(csum_name, data, usedforsecurity=False).hexdigest()
+    return digest
+
+def read_small_file(filename, buf):
+    """
+    Read a whole file into the reusable buffer buf with a single read, and
+    return a memoryview of its content, or None if the file does not fit.
+    """
+    fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if hasattr(os, 'readv'):
+            n = os.readv(fd, [buf])
+        else:
+            data = os.read(fd, len(buf))
+            n = len(data)
+            buf[:n] = data
+    finally:
+        os.close(fd)
+    if n == len(buf):
+        return None
+    return memoryview(buf)[:n]
+
 @timer
 def get_hash(filename, hashtype):
     """Return hashes available from hashlib as a string of hexadecimal hash."""
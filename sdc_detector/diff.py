@@ -3,26 +3,48 @@ import logging
 logger = logging.getLogger()
 import pprint
 import re
+import concurrent.futures
+from itertools import repeat
 
 # import dictdiffer # smaller, faster but cannot traverse results
 import deepdiff
 from .tree import (DirTreeGeneratorPureDict,
                    DirTreeGeneratorMixed,
-                   DirTreeGeneratorPureList)
+                   DirTreeGeneratorPureList,
+                   DirTreeGeneratorCompact)
+from .manifest import iter_tree_records
+from .index import classify_unmatched, DUPLICATED, MISSING, ADDED
+from .filters import prune_tree
 
 
-def get_comparison(tree_struct):
+def get_comparison(tree_struct, jobs=1):
     if tree_struct == DirTreeGeneratorPureDict:
-        return ComparisonPureDict()
+        return ComparisonPureDict(jobs)
     elif tree_struct == DirTreeGeneratorMixed:
-        return ComparisonMixed()
+        return ComparisonMixed(jobs)
     elif tree_struct == DirTreeGeneratorPureList:
-        return ComparisonPureList()
+        return ComparisonPureList(jobs)
+    elif tree_struct == DirTreeGeneratorCompact:
+        return ComparisonCompact(jobs)
+
+
+class ComparisonResult:
+    """Changes found by one comparison (or one shard of a comparison)."""
+    def __init__(self):
+        self.had_diff = False
+        self.changed = {}  # path -> list of change descriptions
+
+    def merge(self, other):
+        self.had_diff |= other.had_diff
+        for path, changes in other.changed.items():
+            self.changed.setdefault(path, []).extend(changes)
 
 
 class TreeComparison:
-    # Can be tied to class, as it is a singleton.
-    results = {}
+    tree_type = None
+
+    def __init__(self, jobs=1):
+        self._jobs = jobs
 
     def compare(self, tree1, tree2):
         type1 = type(tree1)
@@ -41,13 +63,62 @@ class DeepDiffComparison(TreeComparison):
     def _compare(self, tree1, tree2):
         """
         Use deepdiff to compare and print differences between two tree strucs.
+        The trees are split by top level subtree, and each pair of subtrees is
+        diffed separately, on a process pool if more than one job is allowed.
         """
-        ddiff = self._get_diff(tree1, tree2)
+        records1 = list(iter_tree_records(tree1, self.tree_type))
+        records2 = list(iter_tree_records(tree2, self.tree_type))
+        # Files whose path is only in one tree are matched by content instead
+        # of relying on deepdiff pairing heuristics: they are left out of the
+        # trees given to deepdiff.
+        unmatched = classify_unmatched(records1, records2)
+
+        shards1 = self._split(tree1)
+        shards2 = self._split(tree2)
+        result = ComparisonResult()
+        # Subtrees found on one side only hold no changed file, their content
+        # is reported below as unmatched.
+        if shards1.keys() != shards2.keys():
+            result.had_diff = True
+        if unmatched:
+            common = {r.path for r in records1} & {r.path for r in records2}
+            shards1 = self._split(_common_tree(tree1, self.tree_type, common))
+            shards2 = self._split(_common_tree(tree2, self.tree_type, common))
+        keys = sorted(shards1.keys() & shards2.keys())
+
+        if self._jobs > 1 and len(keys) > 1:
+            with concurrent.futures.ProcessPoolExecutor(self._jobs) as executor:
+                shard_results = executor.map(_compare_shard,
+                    repeat(type(self)),
+                    (shards1[k] for k in keys),
+                    (shards2[k] for k in keys)
+                )
+                # map() yields in submission order, so the report is stable
+                for shard_result in shard_results:
+                    result.merge(shard_result)
+        else:
+            for k in keys:
+                result.merge(_compare_shard(type(self), shards1[k], shards2[k]))
+
+        had_diff = result.had_diff
+        for k, v in result.changed.items():
+            had_diff = True
+            sentence = ", ".join(v)
+            print(f"{k} {sentence}")
+
+        if unmatched:
+            had_diff = True
+            print_unmatched(unmatched)
 
-        had_diff = False
+        return had_diff
+
+    def _diff_shard(self, tree1, tree2):
+        """Diff two subtrees and return their ComparisonResult."""
+        result = ComparisonResult()
+        ddiff = self._get_diff(tree1, tree2)
 
         if not ddiff:
-            return had_diff
+            return result
 
         if logger.isEnabledFor(logging.DEBUG):
             pprint.pprint(ddiff, indent=2)
@@ -58,7 +129,7 @@ class DeepDiffComparison(TreeComparison):
         set_added = ddiff.get('iterable_item_added')\
                     or ddiff.get('dictionary_item_added')
         if set_added is not None:
-            had_diff = True
+            result.had_diff = True
             list_added = list(set_added)
             for item in list_added:
                 logger.debug(f"added path: {item.path()}"\
@@ -67,7 +138,7 @@ class DeepDiffComparison(TreeComparison):
         set_removed = ddiff.get('iterable_item_removed')\
                     or ddiff.get('dictionary_item_removed')
         if set_removed is not None:
-            had_diff = True
+            result.had_diff = True
             list_removed = list(set_removed)
             for item in list_removed:
                 logger.debug(f"removed path: {item.path()}"\
@@ -75,16 +146,11 @@ class DeepDiffComparison(TreeComparison):
 
         set_changed = ddiff.get('values_changed')
         if set_changed is not None:
-            had_diff = True
-            changed_dict = self.parse_ddiff_changed(set_changed, tree1)
-            for k, v in changed_dict.items():
-                sentence = ", ".join(v)
-                print(f"{k} {sentence}")
-
-        return had_diff
+            self.parse_ddiff_changed(set_changed, tree1, result)
+        return result
 
     @classmethod
-    def add_to_result(cls, parsed_path, change_type, change):
+    def add_to_result(cls, result, parsed_path, change_type, change):
         if change_type == "n":
             _type = "Filename"
         elif change_type == "cs":
@@ -94,22 +160,52 @@ class DeepDiffComparison(TreeComparison):
         else:
             return
         logger.debug(f"{_type} changed for {parsed_path} from {change.t1} to {change.t2}")
-        append_to_list(cls.results, parsed_path, \
+        append_to_list(result.changed, parsed_path, \
                            f"{_type} changed from {change.t1} to {change.t2}")
 
     @classmethod
-    def parse_ddiff_changed(cls, set_changed, base_tree):
+    def parse_ddiff_changed(cls, set_changed, base_tree, result):
         raise NotImplementedError
 
     def _get_diff(self, tree1, tree2):
         raise NotImplementedError
 
+    def _split(self, tree):
+        """Return {top level name: subtree}, top level files under key ''.
+        Each subtree has the same layout as the whole tree."""
+        raise NotImplementedError
+
+
+def _common_tree(tree, tree_type, common):
+    """Return a copy of tree holding only the files whose path is in common,
+    and the directories holding them."""
+    dirs = {""}
+    for path in common:
+        path = os.path.dirname(path)
+        while path not in dirs:
+            dirs.add(path)
+            path = os.path.dirname(path)
+
+    def excluded(relpath, is_dir=False):
+        return relpath not in (dirs if is_dir else common)
+    # Only the top level is modified in place
+    tree = dict(tree) if tree_type == 'mixed_dict' else \
+        list(tree) if tree_type == 'pure_list' else tree
+    return prune_tree(tree, tree_type, excluded)
+
+
+def _compare_shard(comparison_cls, tree1, tree2):
+    """Entry point of the worker processes."""
+    return comparison_cls()._diff_shard(tree1, tree2)
+
 
 class ComparisonMixed(DeepDiffComparison):
     """
     This class depends on tree struct implementation based on both Dicts
     and Lists: Lists for files in each directory content.
     """
+    tree_type = 'mixed_dict'
+
     def _get_diff(self, tree1, tree2):
         return deepdiff.DeepDiff(
             tree1, tree2,
@@ -121,13 +217,28 @@ class ComparisonMixed(DeepDiffComparison):
             cutoff_intersection_for_pairs=1.0
         )
 
+    def _split(self, tree):
+        shards = {}
+        for item in tree['root']:
+            if len(item) == 1:
+                (name, content), = item.items()
+                if isinstance(content, list):
+                    shards[name] = {'root': [item]}
+                    continue
+            shards.setdefault('', {'root': []})['root'].append(item)
+        return shards
+
     @classmethod
-    def parse_ddiff_changed(cls, set_changed, base_tree):
+    def parse_ddiff_changed(cls, set_changed, base_tree, result):
         list_changed = list(set_changed)  # list of DiffLevel
         logger.debug(f"list_changed: {list_changed}")
+        leaves = {}  # several values may change on the same leaf
 
         for change in list_changed:
-            leaf = deepdiff.extract(base_tree, cls.get_leaf_from_path(change.path()))
+            leaf_path = cls.get_leaf_from_path(change.path())
+            leaf = leaves.get(leaf_path)
+            if leaf is None:
+                leaf = leaves[leaf_path] = deepdiff.extract(base_tree, leaf_path)
             logger.debug(f"leaf: {leaf}")
             fname = leaf.get("n")
             logger.debug(f"---\nfilename: {fname}")
@@ -136,8 +247,8 @@ class ComparisonMixed(DeepDiffComparison):
             logger.debug(f"parsed_path: {parsed_path}")
 
             prop = split_ddiff_path(change.path())[-1]
-            cls.add_to_result(parsed_path, prop, change)
-        return cls.results
+            cls.add_to_result(result, parsed_path, prop, change)
+        return result.changed
 
     @classmethod
     def _get_path_from_str(cls, string):
@@ -166,6 +277,8 @@ class ComparisonPureDict(DeepDiffComparison):
     """
     This class depends on tree struct implementation based purely on Dicts.
     """
+    tree_type = 'pure_dict'
+
     def _get_diff(self, tree1, tree2):
         return deepdiff.DeepDiff(
             tree1, tree2,
@@ -177,8 +290,17 @@ class ComparisonPureDict(DeepDiffComparison):
             cutoff_intersection_for_pairs=1.0
         )
 
+    def _split(self, tree):
+        shards = {}
+        for name, content in tree.items():
+            if 'cs' in content and not isinstance(content['cs'], dict):
+                shards.setdefault('', {})[name] = content
+            else:
+                shards[name] = {name: content}
+        return shards
+
     @classmethod
-    def parse_ddiff_changed(cls, set_changed, base_tree):
+    def parse_ddiff_changed(cls, set_changed, base_tree, result):
         list_changed = list(set_changed)  # list of DiffLevel
         logger.debug(f"list_changed: {list_changed}")
 
@@ -190,8 +312,8 @@ class ComparisonPureDict(DeepDiffComparison):
             logger.debug(f"parsed_path: {parsed_path}")
 
             prop = split_ddiff_path(change.path())[-1]
-            cls.add_to_result(parsed_path, prop, change)
-        return cls.results
+            cls.add_to_result(result, parsed_path, prop, change)
+        return result.changed
 
     @classmethod
     def _get_path_from_str(cls, string):
@@ -217,6 +339,8 @@ class ComparisonPureList(DeepDiffComparison):
     """
     This class depends on the tree struct implementation based purely on Lists.
     """
+    tree_type = 'pure_list'
+
     def _get_diff(self, tree1, tree2):
         # FIXME ddiff does not work well with purely list based tree structs:
         # leaf nodes differences are not correctly reported. File names,
@@ -235,8 +359,22 @@ class ComparisonPureList(DeepDiffComparison):
             cutoff_intersection_for_pairs=1.0
         )
 
+    def _split(self, tree):
+        shards = {}
+        for item in tree[1:]:
+            if not item:
+                continue
+            if isinstance(item[0], list):
+                # Anonymous list holding the files of the root directory
+                shards.setdefault('', ['root']).extend(item)
+            elif len(item) == 3 and not isinstance(item[1], list):
+                shards.setdefault('', ['root']).append(item)
+            else:
+                shards[item[0]] = ['root', item]
+        return shards
+
     @classmethod
-    def parse_ddiff_changed(cls, set_changed, base_tree):
+    def parse_ddiff_changed(cls, set_changed, base_tree, result):
         list_changed = list(set_changed)  # list of DiffLevel
         logger.debug(f"list_changed: {list_changed}")
 
@@ -253,12 +391,12 @@ class ComparisonPureList(DeepDiffComparison):
 
             prop = path_list[-1]
             if prop == "1":
-                cls.add_to_result(parsed_path, "cs", change)
+                cls.add_to_result(result, parsed_path, "cs", change)
             elif prop == "2":
-                cls.add_to_result(parsed_path, "sz", change)
+                cls.add_to_result(result, parsed_path, "sz", change)
             elif prop == "0":
-                cls.add_to_result(parsed_path, "n", change)
-        return cls.results
+                cls.add_to_result(result, parsed_path, "n", change)
+        return result.changed
 
 
     @classmethod
@@ -296,6 +434,49 @@ class ComparisonPureList(DeepDiffComparison):
         return s
 
 
+class ComparisonCompact(TreeComparison):
+    """
+    This class depends on the CompactTree implementation. Files are matched
+    in a single pass, without deepdiff and without rebuilding their paths.
+    """
+    tree_type = 'compact'
+
+    def _compare(self, tree1, tree2):
+        # Files are matched by (directory id, name id) keys instead of paths
+        name_ids = None
+        if tree2.names is not tree1.names:
+            name_ids = [tree1.names.id(n) for n in tree2.names.names]
+        dir_ids = {}
+        files2 = dict(tree2.file_keys(dir_ids, name_ids))
+        result = ComparisonResult()
+        unmatched1 = False
+
+        for key, i in tree1.file_keys(dir_ids):
+            j = files2.pop(key, None)
+            if j is None:
+                unmatched1 = True
+                continue
+            cs1, cs2 = tree1.checksum(i), tree2.checksum(j)
+            if cs1 != cs2:
+                append_to_list(result.changed, tree1.path(i),
+                    f"CSUM changed from {cs1} to {cs2}")
+            sz1, sz2 = tree1.sizes[i], tree2.sizes[j]
+            if sz1 != sz2:
+                append_to_list(result.changed, tree1.path(i),
+                    f"Size changed from {sz1} to {sz2}")
+
+        for k, v in result.changed.items():
+            sentence = ", ".join(v)
+            print(f"{k} {sentence}")
+
+        unmatched = []
+        if unmatched1 or files2:
+            unmatched = classify_unmatched(tree1.records(), tree2.records())
+            print_unmatched(unmatched)
+
+        return bool(result.changed or unmatched)
+
+
 def split_ddiff_path(string):
     """
     Returns a list made of a deepdiff path.
@@ -306,6 +487,18 @@ def split_ddiff_path(string):
     logger.debug(f"split_ddif_path(): {res}")
     return res
 
+def print_unmatched(unmatched):
+    """Print the output of classify_unmatched()."""
+    for kind, path1, path2 in unmatched:
+        if kind == MISSING:
+            print(f"{path1} {kind}")
+        elif kind == ADDED:
+            print(f"{path2} {kind}")
+        elif kind == DUPLICATED:
+            print(f"{path2} {kind} from {path1}")
+        else:
+            print(f"{path1} {kind} to {path2}")
+
 def append_to_list(_dict, _key, _string):
     """Append string to _list pointed by _key of _dict,
        or create a new list at key if doesn't exist.
@@ -0,0 +1,61 @@
+import os
+import struct
+import logging
+logger = logging.getLogger()
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# From <linux/fiemap.h> and <linux/fs.h>
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x00000001
+FIEMAP_EXTENT_LAST = 0x00000001
+FIEMAP_EXTENT_UNKNOWN = 0x00000002
+FIEMAP_EXTENT_DELALLOC = 0x00000004
+FIEMAP_EXTENT_ENCODED = 0x00000008
+FIEMAP_EXTENT_DATA_INLINE = 0x00000200
+FIEMAP_EXTENT_SHARED = 0x00002000
+# Extents whose physical address can't identify the data
+_UNRELIABLE = FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC \
+    | FIEMAP_EXTENT_ENCODED | FIEMAP_EXTENT_DATA_INLINE
+
+_FIEMAP = struct.Struct('QQIIII')  # start, length, flags, mapped, count, reserved
+_EXTENT = struct.Struct('QQQQQIIII')  # logical, physical, length, reserved64[2], flags, reserved[3]
+MAX_EXTENTS = 32
+
+
+def get_shared_extents(fpath):
+    """
+    Return a tuple of (logical, physical, length) for the extents of fpath
+    if they are all shared with other files (reflinks, deduplicated data),
+    or None. Two files with the same size and shared extents hold the same
+    data. Files with more than MAX_EXTENTS extents are not considered.
+    """
+    if fcntl is None:
+        return None
+    buf = bytearray(_FIEMAP.size + _EXTENT.size * MAX_EXTENTS)
+    _FIEMAP.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC,
+                      0, MAX_EXTENTS, 0)
+    fd = os.open(fpath, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError as e:
+        # EOPNOTSUPP: the file system has no FIEMAP support
+        logger.debug(f"FIEMAP failed on {fpath}: {e}")
+        return None
+    finally:
+        os.close(fd)
+
+    mapped = _FIEMAP.unpack_from(buf, 0)[3]
+    extents = []
+    for i in range(mapped):
+        logical, physical, length, _, _, flags, _, _, _ = \
+            _EXTENT.unpack_from(buf, _FIEMAP.size + i * _EXTENT.size)
+        if flags & _UNRELIABLE or not flags & FIEMAP_EXTENT_SHARED:
+            return None
+        extents.append((logical, physical, length))
+        if flags & FIEMAP_EXTENT_LAST:
+            return tuple(extents)
+    # No extent (holes only), or more than MAX_EXTENTS
+    return None
@@ -0,0 +1,279 @@
+import os
+import re
+import fnmatch
+import logging
+logger = logging.getLogger()
+
+from .compact import CompactTree
+
+IGNORE_FILE = '.sdcignore'
+REGEX_PREFIX = 're:'
+
+
+class Matcher:
+    """
+    Rules compiled into two regular expressions: globs without a "/" are
+    matched against names, like in .gitignore files, other globs against
+    the whole relative path, and rules prefixed with "re:" are regular
+    expressions searched in the relative path.
+    """
+    __slots__ = ('names', 'paths')
+
+    def __init__(self, rules):
+        names, paths = [], []
+        for rule in rules:
+            if rule.startswith(REGEX_PREFIX):
+                paths.append(f"(?s:.*?(?:{rule[len(REGEX_PREFIX):]}))")
+                continue
+            rule = rule.rstrip('/')
+            if '/' in rule:
+                paths.append(fnmatch.translate(rule.lstrip('/')))
+            else:
+                names.append(fnmatch.translate(rule))
+        self.names = re.compile('|'.join(names)) if names else None
+        self.paths = re.compile('|'.join(paths)) if paths else None
+
+    def match(self, relpath, name, is_dir=False):
+        if self.names is not None and self.names.match(name):
+            return True
+        if self.paths is None:
+            return False
+        # Directories also match the rules ending with a "/"
+        return bool(self.paths.match(relpath)
+                    or is_dir and self.paths.match(relpath + '/'))
+
+
+def rule_error(rule):
+    """Return why rule can't be compiled, or None."""
+    try:
+        Matcher([rule])
+    except re.error as e:
+        return str(e)
+    return None
+
+
+def valid_rules(rules, source):
+    """Return the rules that can be compiled, logging the others."""
+    valid = []
+    for rule in rules:
+        error = rule_error(rule)
+        if error is None:
+            valid.append(rule)
+        else:
+            logger.critical(f"\nIgnoring rule {rule!r} of {source}: {error}")
+    return valid
+
+
+class PathFilter:
+    """
+    Exclude and include rules applied to paths relative to the root of a
+    tree. Excluded directories are pruned with their whole content. When
+    there are include rules, files must also match one of them.
+    Ignore files found in a directory hold exclude rules for that directory,
+    their globs with a "/" being relative to it.
+    """
+    def __init__(self, exclude=(), include=(), ignore_file=IGNORE_FILE,
+                 ignored=None):
+        self.exclude = list(exclude)
+        self.include = list(include)
+        self.ignore_file = ignore_file
+        self.ignored = {}  # relative directory -> rules of its ignore file
+        self._exclude = Matcher(self.exclude)
+        self._include = Matcher(self.include) if self.include else None
+        self._scoped = {}  # relative directory -> Matcher
+        for reldir, rules in (ignored or {}).items():
+            self._add_scope(reldir, rules)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.exclude, args.include, args.ignore_file)
+
+    @classmethod
+    def from_header(cls, filters):
+        """Rebuild the filter recorded in a manifest header, if any."""
+        filters = filters or {}
+        source = "a result file header"
+        ignored = {reldir: valid_rules(rules, source)
+                   for reldir, rules in (filters.get('ignored') or {}).items()}
+        return cls(valid_rules(filters.get('exclude', ()), source),
+                   valid_rules(filters.get('include', ()), source),
+                   filters.get('ignore_file'), ignored)
+
+    def header(self):
+        """Return the rules as recorded in manifest headers, or None."""
+        if not self:
+            return None
+        return {
+            'exclude': self.exclude,
+            'include': self.include,
+            'ignore_file': self.ignore_file,
+            'ignored': self.ignored,
+        }
+
+    def __bool__(self):
+        return bool(self.exclude or self.include or self.ignored)
+
+    def _add_scope(self, reldir, rules):
+        self.ignored[reldir] = rules
+        self._scoped[reldir] = Matcher(rules)
+
+    def load_ignore_file(self, dirpath, reldir):
+        """(Re)load the ignore file of directory dirpath, at reldir in the
+        tree."""
+        self.ignored.pop(reldir, None)
+        self._scoped.pop(reldir, None)
+        fpath = os.path.join(dirpath, self.ignore_file)
+        try:
+            with open(fpath, encoding='utf-8') as fp:
+                rules = [line.strip() for line in fp]
+        except FileNotFoundError:
+            return
+        except (OSError, UnicodeDecodeError) as e:
+            logger.critical(f"\n{e}")
+            return
+        rules = valid_rules(
+            [r for r in rules if r and not r.startswith('#')], fpath)
+        if rules:
+            self._add_scope(reldir, rules)
+
+    def excluded(self, relpath, is_dir=False):
+        """Whether relpath, relative to the root, is filtered out."""
+        if os.sep != '/':
+            relpath = relpath.replace(os.sep, '/')
+        name = relpath.rpartition('/')[2]
+        if not is_dir and name == self.ignore_file:
+            return True
+        if self._exclude.match(relpath, name, is_dir):
+            return True
+        if self._scoped:
+            # Rules of the ignore files of the ancestors of relpath
+            start = 0
+            while True:
+                reldir = relpath[:start - 1] if start else ""
+                matcher = self._scoped.get(reldir)
+                if matcher is not None \
+                        and matcher.match(relpath[start:], name, is_dir):
+                    return True
+                start = relpath.find('/', start) + 1
+                if not start:
+                    break
+        if not is_dir and self._include is not None:
+            return not self._include.match(relpath, name)
+        return False
+
+    def filter_entries(self, dirpath, reldir, dirs, files):
+        """Return the dirs and files of directory dirpath, at reldir in the
+        tree, that are not filtered out, reading its ignore file first.
+        Ignore files are not hashed."""
+        if self.ignore_file and self.ignore_file in files:
+            self.load_ignore_file(dirpath, reldir)
+            files = [f for f in files if f != self.ignore_file]
+        if not self:
+            return dirs, files
+        prefix = reldir + os.sep if reldir else ""
+        return ([d for d in dirs if not self.excluded(prefix + d, True)],
+                [f for f in files if not self.excluded(prefix + f)])
+
+
+def excluded_by_any(filters):
+    """Return an excluded(relpath, is_dir) function applying all filters."""
+    filters = [f for f in filters if f]
+    def excluded(relpath, is_dir=False):
+        return any(f.excluded(relpath, is_dir) for f in filters)
+    return excluded
+
+
+def filter_records(records, excluded):
+    """Yield the records that are not excluded, nor any of their parent
+    directories."""
+    excluded = excluded_with_parents(excluded)
+    for record in records:
+        if not excluded(record.path):
+            yield record
+
+
+def excluded_with_parents(excluded):
+    """Return an excluded(relpath) function for file paths, also true when
+    one of the parent directories is excluded."""
+    dirs = {"": False}  # relative directory -> excluded
+
+    def dir_excluded(reldir):
+        verdict = dirs.get(reldir)
+        if verdict is None:
+            parent, _, _ = reldir.rpartition(os.sep)
+            verdict = dirs[reldir] = dir_excluded(parent) \
+                or excluded(reldir, True)
+        return verdict
+
+    def file_excluded(relpath):
+        reldir, _, _ = relpath.rpartition(os.sep)
+        return dir_excluded(reldir) or excluded(relpath)
+    return file_excluded
+
+
+def prune_tree(tree, tree_type, excluded):
+    """Return tree without the files and directories for which
+    excluded(relpath, is_dir) is true."""
+    if tree_type == 'mixed_dict':
+        tree['root'] = _prune_mixed(tree['root'], "", excluded)
+        return tree
+    elif tree_type == 'pure_dict':
+        return _prune_pure_dict(tree, "", excluded)
+    elif tree_type == 'pure_list':
+        tree[1:] = _prune_pure_list(tree[1:], "", excluded)
+        return tree
+    elif tree_type == 'compact':
+        return CompactTree.from_records(
+            filter_records(tree.records(), excluded),
+            tree.csum_name, tree.names)
+    raise ValueError(f"Unknown tree type: {tree_type}")
+
+
+def _prune_mixed(items, prefix, excluded):
+    kept = []
+    for item in items:
+        if not item:
+            # Placeholder for a directory that could not be read
+            kept.append(item)
+            continue
+        if len(item) == 1:
+            (name, content), = item.items()
+            if isinstance(content, list):
+                if not excluded(prefix + name, True):
+                    kept.append({name: _prune_mixed(
+                        content, prefix + name + os.sep, excluded)})
+                continue
+        if not excluded(prefix + item['n']):
+            kept.append(item)
+    return kept
+
+
+def _prune_pure_dict(directory, prefix, excluded):
+    kept = {}
+    for name, content in directory.items():
+        if 'cs' in content and not isinstance(content['cs'], dict):
+            if not excluded(prefix + name):
+                kept[name] = content
+        elif not excluded(prefix + name, True):
+            kept[name] = _prune_pure_dict(
+                content, prefix + name + os.sep, excluded)
+    return kept
+
+
+def _prune_pure_list(items, prefix, excluded):
+    kept = []
+    for item in items:
+        if not item:
+            continue
+        if isinstance(item[0], list):
+            # Anonymous list holding the files of a directory without subdirs
+            files = _prune_pure_list(item, prefix, excluded)
+            if files:
+                kept.append(files)
+        elif len(item) == 3 and not isinstance(item[1], list):
+            if not excluded(prefix + item[0]):
+                kept.append(item)
+        elif not excluded(prefix + item[0], True):
+            kept.append([item[0], *_prune_pure_list(
+                item[1:], prefix + item[0] + os.sep, excluded)])
+    return kept
@@ -0,0 +1,111 @@
+import os
+import logging
+logger = logging.getLogger()
+
+# Kinds of unmatched entries, as reported by classify_unmatched()
+MOVED = "Moved"
+RENAMED = "Renamed"
+MOVED_RENAMED = "Moved and renamed"
+DUPLICATED = "Duplicated"
+MISSING = "Missing"
+ADDED = "Added"
+
+
+class ChecksumIndex:
+    """
+    Map (size, checksum) -> paths of the files with that content.
+    Empty and unreadable files (checksum 0) are not indexed, as their content
+    tells nothing about their identity.
+    """
+    def __init__(self, records=()):
+        self._index = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        if not record.size or not record.checksum:
+            return
+        self._index.setdefault((record.size, record.checksum), [])\
+            .append(record.path)
+
+    def get(self, record):
+        return self._index.get((record.size, record.checksum), [])
+
+    def __contains__(self, record):
+        return (record.size, record.checksum) in self._index
+
+    def duplicates(self):
+        """Yield (size, checksum), paths for content found at several paths."""
+        for key, paths in self._index.items():
+            if len(paths) > 1:
+                yield key, paths
+
+
+def classify_unmatched(records1, records2):
+    """
+    Return a sorted list of (kind, path1, path2) for the files whose path is
+    only found in one of the two record sets:
+    * MOVED, RENAMED, MOVED_RENAMED: path1 was found with the same content at
+      path2 only.
+    * DUPLICATED: path2 holds a copy of path1, which is still there.
+    * MISSING: path1 content was not found at any new path (path2 is None).
+    * ADDED: path2 content was not found in the first set (path1 is None).
+    All lookups are hashed, so this runs in linear time.
+    """
+    files1 = {r.path: r for r in records1}
+    files2 = {r.path: r for r in records2}
+    removed = [r for path, r in files1.items() if path not in files2]
+    added = [r for path, r in files2.items() if path not in files1]
+
+    candidates = ChecksumIndex(added)
+    paired = set()
+    results = []
+
+    for record in sorted(removed):
+        paths = [p for p in candidates.get(record) if p not in paired]
+        if not paths:
+            results.append((MISSING, record.path, None))
+            continue
+        new_path = _best_candidate(record.path, paths)
+        paired.add(new_path)
+        results.append((_move_kind(record.path, new_path), record.path, new_path))
+
+    index1 = ChecksumIndex(files1.values())
+    for record in sorted(added):
+        if record.path in paired:
+            continue
+        originals = index1.get(record)
+        if originals:
+            results.append((DUPLICATED, originals[0], record.path))
+        else:
+            results.append((ADDED, None, record.path))
+
+    results.sort(key=lambda r: r[1] or r[2])
+    return results
+
+
+def find_duplicates(records):
+    """Return sorted lists of paths sharing the same content within one tree."""
+    return sorted(sorted(paths)
+                  for _, paths in ChecksumIndex(records).duplicates())
+
+
+def _best_candidate(path, paths):
+    """Prefer a plain move, then a plain rename, to any other copy."""
+    name = os.path.basename(path)
+    for p in paths:
+        if os.path.basename(p) == name:
+            return p
+    parent = os.path.dirname(path)
+    for p in paths:
+        if os.path.dirname(p) == parent:
+            return p
+    return paths[0]
+
+
+def _move_kind(path1, path2):
+    if os.path.basename(path1) == os.path.basename(path2):
+        return MOVED
+    if os.path.dirname(path1) == os.path.dirname(path2):
+        return RENAMED
+    return MOVED_RENAMED
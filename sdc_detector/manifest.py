@@ -0,0 +1,383 @@
+import os
+import logging
+logger = logging.getLogger()
+from collections import namedtuple
+
+from yaml import parse, emit, dump
+from yaml.events import (MappingStartEvent, MappingEndEvent,
+                         SequenceStartEvent, SequenceEndEvent,
+                         ScalarEvent, StreamStartEvent, StreamEndEvent,
+                         DocumentStartEvent, DocumentEndEvent)
+from yaml.nodes import ScalarNode
+from yaml.resolver import Resolver
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:
+    from yaml import Loader, Dumper
+
+from .compress import open_read
+from .names import front_encode
+
+# Flat view of a file entry, whatever the tree layout it was read from.
+# path is relative to the scanned root, without the 'root' node.
+FileRecord = namedtuple('FileRecord', ('path', 'size', 'checksum'))
+
+# Optional first document of a manifest, describing the tree document
+HEADER_KEY = 'sdc_manifest'
+MANIFEST_VERSION = 1
+
+_resolver = Resolver()
+_INT_TAG = 'tag:yaml.org,2002:int'
+_STR_TAG = 'tag:yaml.org,2002:str'
+
+
+def iter_manifest(fpath, tree_type=None):
+    """
+    Yield a FileRecord for each file listed in the YAML file at fpath.
+    The layout is read from the manifest header when tree_type is None.
+    """
+    if tree_type is None:
+        header = read_header(fpath) or {}
+        tree_type = header.get('layout', 'mixed_dict')
+    with open_read(fpath) as fp:
+        yield from iter_records(fp, tree_type)
+
+
+def iter_records(stream, tree_type='mixed_dict'):
+    """
+    Walk the YAML event stream of a manifest and yield a FileRecord for each
+    file, without ever building the nested structure in memory.
+    """
+    try:
+        walk = _WALKERS[tree_type]
+    except KeyError:
+        raise ValueError(f"Unknown tree type: {tree_type}")
+
+    events = _Events(parse(stream, Loader=Loader))
+    for event in events:
+        # Each document holds a single top level collection
+        if isinstance(event, MappingStartEvent):
+            key = next(events)
+            if isinstance(key, ScalarEvent) and key.value == HEADER_KEY:
+                _skip_collection(events)
+                continue
+            events.push(key)
+        if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+            yield from walk(events, event)
+
+
+def make_header(layout, csum_name, filters=None):
+    """Return the document written before the tree in manifests, with the
+    rules of the PathFilter.header() the tree was scanned with, if any."""
+    header = {HEADER_KEY: {
+        'version': MANIFEST_VERSION,
+        'layout': layout,
+        'csum': csum_name,
+    }}
+    if filters:
+        header[HEADER_KEY]['filters'] = filters
+    return header
+
+
+def read_header(fpath):
+    """Return the header of the manifest at fpath, or None for manifests
+    written without one."""
+    with open_read(fpath) as fp:
+        events = parse(fp, Loader=Loader)
+        for event in events:
+            if isinstance(event, SequenceStartEvent):
+                return None
+            if isinstance(event, MappingStartEvent):
+                key = next(events)
+                if not isinstance(key, ScalarEvent) or key.value != HEADER_KEY:
+                    return None
+                break
+        else:
+            return None
+
+    # Only construct the first document, the header
+    with open_read(fpath) as fp:
+        loader = Loader(fp)
+        try:
+            return loader.get_data()[HEADER_KEY]
+        finally:
+            loader.dispose()
+
+
+def dump_front_coded(records, stream, header):
+    """
+    Write records sorted by path in the front_coded layout: one
+    [shared prefix length, path suffix, checksum, size] list per file.
+    Paths of a same directory share most of their prefix, so most of each
+    path is not repeated.
+    """
+    records = sorted(records, key=lambda r: r.path)
+    dump(header, stream=stream, Dumper=Dumper, explicit_start=True)
+    emit(_front_coded_events(records), stream=stream, Dumper=Dumper)
+
+
+class _Events:
+    """Event iterator allowing to push back one event."""
+    def __init__(self, events):
+        self._events = events
+        self._pushed = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._pushed:
+            return self._pushed.pop()
+        return next(self._events)
+
+    def push(self, event):
+        self._pushed.append(event)
+
+
+def _skip_collection(events):
+    """Consume events up to the end of the current collection."""
+    depth = 1
+    while depth:
+        event = next(events)
+        if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (MappingEndEvent, SequenceEndEvent)):
+            depth -= 1
+
+
+def _checksum(event):
+    """Checksums are strings, except for the 0 placeholder of unreadable files."""
+    if event.implicit[0] and \
+        _resolver.resolve(ScalarNode, event.value, (True, False)) == _INT_TAG:
+        return int(event.value)
+    return event.value
+
+
+def _expect(event, event_type):
+    if not isinstance(event, event_type):
+        raise ValueError(f"Unexpected {event} in manifest, "
+                         f"expected {event_type.__name__}.")
+    return event
+
+
+# mixed_dict: {'root': [{dirname: [...]}, {'cs': .., 'n': .., 'sz': ..}, ...]}
+
+def _walk_mixed(events, start):
+    _expect(start, MappingStartEvent)
+    yield from _mixed_entry(events, "", root=True)
+
+
+def _mixed_entry(events, prefix, root=False):
+    """Mapping is either a single {dirname: [...]} pair or a file dict."""
+    fields = {}
+    while True:
+        event = next(events)
+        if isinstance(event, MappingEndEvent):
+            break
+        key = _expect(event, ScalarEvent).value
+        value = next(events)
+        if isinstance(value, SequenceStartEvent):
+            dir_prefix = prefix if root else prefix + key + os.sep
+            yield from _mixed_dir(events, dir_prefix)
+        else:
+            fields[key] = _expect(value, ScalarEvent)
+
+    if fields:
+        yield FileRecord(prefix + fields['n'].value,
+                         int(fields['sz'].value),
+                         _checksum(fields['cs']))
+
+
+def _mixed_dir(events, prefix):
+    while True:
+        event = next(events)
+        if isinstance(event, SequenceEndEvent):
+            return
+        _expect(event, MappingStartEvent)
+        yield from _mixed_entry(events, prefix)
+
+
+# pure_dict: {dirname: {...}, filename: {'cs': .., 'sz': ..}}
+
+def _walk_pure_dict(events, start):
+    _expect(start, MappingStartEvent)
+    yield from _pure_dict_dir(events, "")
+
+
+def _pure_dict_dir(events, prefix):
+    while True:
+        event = next(events)
+        if isinstance(event, MappingEndEvent):
+            return
+        name = _expect(event, ScalarEvent).value
+        _expect(next(events), MappingStartEvent)
+        yield from _pure_dict_node(events, prefix + name)
+
+
+def _pure_dict_node(events, path):
+    """Values of a file mapping are scalars, those of a directory are mappings."""
+    event = next(events)
+    if isinstance(event, MappingEndEvent):
+        return  # empty directory
+    key = _expect(event, ScalarEvent).value
+    value = next(events)
+
+    if isinstance(value, MappingStartEvent):
+        yield from _pure_dict_node(events, path + os.sep + key)
+        yield from _pure_dict_dir(events, path + os.sep)
+        return
+
+    fields = {key: _expect(value, ScalarEvent)}
+    while True:
+        event = next(events)
+        if isinstance(event, MappingEndEvent):
+            break
+        fields[_expect(event, ScalarEvent).value] = \
+            _expect(next(events), ScalarEvent)
+    yield FileRecord(path, int(fields['sz'].value), _checksum(fields['cs']))
+
+
+# pure_list: ['root', ['dirname', ...], [[filename, cs, sz], ...], [filename, cs, sz]]
+
+def _walk_pure_list(events, start):
+    _expect(start, SequenceStartEvent)
+    yield from _pure_list_node(events, "", root=True)
+
+
+def _pure_list_node(events, prefix, root=False):
+    event = next(events)
+    if isinstance(event, SequenceEndEvent):
+        return  # unreadable directory
+
+    if isinstance(event, SequenceStartEvent):
+        # Anonymous list holding the files of a directory without subdirs
+        yield from _pure_list_node(events, prefix)
+        yield from _pure_list_items(events, prefix)
+        return
+
+    name = _expect(event, ScalarEvent).value
+    event = next(events)
+    if isinstance(event, ScalarEvent):
+        # [filename, cs, sz]
+        size = _expect(next(events), ScalarEvent)
+        _expect(next(events), SequenceEndEvent)
+        yield FileRecord(prefix + name, int(size.value), _checksum(event))
+        return
+
+    dir_prefix = prefix if root else prefix + name + os.sep
+    if isinstance(event, SequenceEndEvent):
+        return  # empty directory
+    _expect(event, SequenceStartEvent)
+    yield from _pure_list_node(events, dir_prefix)
+    yield from _pure_list_items(events, dir_prefix)
+
+
+def _pure_list_items(events, prefix):
+    while True:
+        event = next(events)
+        if isinstance(event, SequenceEndEvent):
+            return
+        _expect(event, SequenceStartEvent)
+        yield from _pure_list_node(events, prefix)
+
+
+# front_coded: [[shared prefix length, path suffix, cs, sz], ...]
+
+def _walk_front_coded(events, start):
+    _expect(start, SequenceStartEvent)
+    path = ""
+    while True:
+        event = next(events)
+        if isinstance(event, SequenceEndEvent):
+            return
+        _expect(event, SequenceStartEvent)
+        shared = int(_expect(next(events), ScalarEvent).value)
+        suffix = _expect(next(events), ScalarEvent).value
+        checksum = _checksum(_expect(next(events), ScalarEvent))
+        size = int(_expect(next(events), ScalarEvent).value)
+        _expect(next(events), SequenceEndEvent)
+        path = path[:shared] + suffix
+        yield FileRecord(path, size, checksum)
+
+
+def _front_coded_events(records):
+    yield StreamStartEvent()
+    yield DocumentStartEvent(explicit=True)
+    yield SequenceStartEvent(None, None, True)
+    for (shared, suffix), record in zip(
+            front_encode(r.path for r in records), records):
+        yield SequenceStartEvent(None, None, True, flow_style=True)
+        yield ScalarEvent(None, None, (True, False), str(shared))
+        yield str_event(suffix)
+        if isinstance(record.checksum, int):
+            yield ScalarEvent(None, None, (True, False), str(record.checksum))
+        else:
+            yield str_event(record.checksum)
+        yield ScalarEvent(None, None, (True, False), str(record.size))
+        yield SequenceEndEvent()
+    yield SequenceEndEvent()
+    yield DocumentEndEvent()
+    yield StreamEndEvent()
+
+
+def str_event(value):
+    """Return a ScalarEvent for a string, quoted only when it would resolve
+    to another type as a plain scalar."""
+    plain = _resolver.resolve(ScalarNode, value, (True, False)) == _STR_TAG
+    return ScalarEvent(None, None, (plain, True), value)
+
+
+_WALKERS = {
+    'mixed_dict': _walk_mixed,
+    'pure_dict': _walk_pure_dict,
+    'pure_list': _walk_pure_list,
+    'front_coded': _walk_front_coded,
+}
+
+
+def iter_tree_records(tree, tree_type='mixed_dict'):
+    """Yield a FileRecord for each file of an in-memory tree structure."""
+    if tree_type == 'mixed_dict':
+        yield from _tree_mixed(tree['root'], "")
+    elif tree_type == 'pure_dict':
+        yield from _tree_pure_dict(tree, "")
+    elif tree_type == 'pure_list':
+        yield from _tree_pure_list(tree[1:], "")
+    elif tree_type == 'compact':
+        yield from tree.records()
+    else:
+        raise ValueError(f"Unknown tree type: {tree_type}")
+
+
+def _tree_mixed(items, prefix):
+    for item in items:
+        if not item:
+            # Placeholder for a directory that could not be read
+            continue
+        if len(item) == 1:
+            (name, content), = item.items()
+            if isinstance(content, list):
+                yield from _tree_mixed(content, prefix + name + os.sep)
+                continue
+        yield FileRecord(prefix + item['n'], item['sz'], item['cs'])
+
+
+def _tree_pure_dict(directory, prefix):
+    for name, content in directory.items():
+        if 'cs' in content and not isinstance(content['cs'], dict):
+            yield FileRecord(prefix + name, content['sz'], content['cs'])
+        else:
+            yield from _tree_pure_dict(content, prefix + name + os.sep)
+
+
+def _tree_pure_list(items, prefix):
+    for item in items:
+        if not item:
+            continue
+        if isinstance(item[0], list):
+            # Anonymous list holding the files of a directory without subdirs
+            yield from _tree_pure_list(item, prefix)
+        elif len(item) == 3 and not isinstance(item[1], list):
+            yield FileRecord(prefix + item[0], item[2], item[1])
+        else:
+            yield from _tree_pure_list(item[1:], prefix + item[0] + os.sep)
@@ -0,0 +1,48 @@
+import os
+import threading
+
+
+class NameTable:
+    """
+    Interning table for path components (file and directory names).
+    Each distinct name is stored once and gets a small integer id, so the
+    same table can be shared by the generators of both trees of a comparison
+    and names can be compared by id.
+    """
+    def __init__(self):
+        self.names = []  # id -> name
+        self._ids = {}  # name -> id
+        self._lock = threading.Lock()  # generators run in threads
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, name):
+        name_id = self._ids.get(name)
+        if name_id is None:
+            with self._lock:
+                name_id = self._ids.get(name)
+                if name_id is None:
+                    name_id = self._ids[name] = len(self.names)
+                    self.names.append(name)
+        return name_id
+
+    def intern(self, name):
+        """Return the stored copy of name."""
+        return self.names[self.id(name)]
+
+    def name(self, name_id):
+        return self.names[name_id]
+
+
+def front_encode(paths):
+    """
+    Front coding of sorted paths: yield (length of the prefix shared with the
+    previous path, remaining suffix) for each path.
+    """
+    previous = ""
+    for path in paths:
+        shared = len(os.path.commonprefix((previous, path)))
+        yield shared, path[shared:]
+        previous = path
+
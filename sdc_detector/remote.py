@@ -0,0 +1,459 @@
+import os
+import hmac
+import json
+import signal
+import socket
+import ipaddress
+import hashlib
+import functools
+import logging
+logger = logging.getLogger()
+from bisect import bisect_left
+from pathlib import Path
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+from .csum import get_digest_func
+from .manifest import FileRecord, iter_manifest, read_header
+from .index import classify_unmatched
+from .diff import ComparisonResult, append_to_list, print_unmatched
+from .tree import DirTreeGeneratorCompact
+from .filters import PathFilter, excluded_by_any, filter_records
+from .watch import _interrupt
+
+SCHEMES = ('tcp', 'unix')
+BLOCK_SIZE = 1 << 20  # default size of the blocks hashed on demand
+MIN_BLOCK_SIZE = 1 << 16  # smaller blocks would give away file contents
+PRUNE_SIZE = 10000  # subtrees with fewer files are compared record by record
+
+
+def is_address(path):
+    """Whether path is the address of an agent, like tcp://host:port or
+    unix:///path/to/socket."""
+    return urlsplit(path).scheme in SCHEMES
+
+def _key(path):
+    # Records are sorted by path components, which is the order of a
+    # depth-first walk and keeps the content of a directory contiguous
+    return tuple(path.split(os.sep))
+
+def _record_line(record):
+    return f"{record.path}\0{record.size}\0{record.checksum}\n".encode(
+        'utf-8', 'surrogateescape')
+
+
+class ScanAgent:
+    """
+    Scan a tree, or read a result file, and answer requests about it:
+    records of a subtree sorted by path, aggregate hashes of subtrees, and
+    hashes of the blocks of a file. Comparisons call it directly for a local
+    tree, and through an AgentClient for a tree on another host.
+    """
+    def __init__(self, path, args, printer):
+        self._path = Path(path)
+        self._args = args
+        self._printer = printer
+        self.csum_name = args.csum_name
+        self._min_block_size = getattr(args, 'min_block_size', MIN_BLOCK_SIZE)
+        self._filters = None  # PathFilter.header() of the last scan
+        self._records = []  # FileRecords sorted by _key()
+        self._keys = []
+
+    def scan(self):
+        """Scan the tree, and return the checksum name and the filters it
+        was scanned with, along with aggregate()."""
+        if self._path.is_dir():
+            gen = DirTreeGeneratorCompact(self._path, self._args, self._printer)
+            records = gen.generate(no_output=True).records()
+            self._printer.done()
+            self._filters = gen.path_filter.header()
+        else:
+            header = read_header(self._path) or {}
+            self.csum_name = header.get('csum', self.csum_name)
+            self._filters = header.get('filters')
+            records = iter_manifest(self._path, header.get('layout',
+                                                           'mixed_dict'))
+        self._set_records(sorted(records, key=lambda r: _key(r.path)))
+        return {'csum': self.csum_name, 'filters': self._filters,
+                **self.aggregate("")}
+
+    def filter(self, filters):
+        """Also drop the records excluded by any of the PathFilter.header()
+        filters, and return aggregate()."""
+        excluded = excluded_by_any(PathFilter.from_header(f) for f in filters)
+        self._set_records(list(filter_records(self._records, excluded)))
+        return self.aggregate("")
+
+    def _set_records(self, records):
+        self._records = records
+        self._keys = [_key(r.path) for r in records]
+
+    def _range(self, path):
+        """Return the bounds of the records under path ("" for all)."""
+        if not path:
+            return 0, len(self._keys)
+        parts = _key(path)
+        # Names can't hold NUL: this sorts right after the whole subtree
+        end = parts[:-1] + (parts[-1] + '\0',)
+        return bisect_left(self._keys, parts), bisect_left(self._keys, end)
+
+    def aggregate(self, path):
+        """
+        Return the number of files and the aggregate hash of the subtree at
+        path, along with [files, hash] for each of its subdirectories.
+        Equal hashes mean equal paths, sizes and checksums.
+        """
+        lo, hi = self._range(path)
+        depth = len(_key(path)) if path else 0
+        total = hashlib.sha1()
+        dirs = {}
+        for i in range(lo, hi):
+            line = _record_line(self._records[i])
+            total.update(line)
+            parts = self._keys[i]
+            if len(parts) > depth + 1:
+                sub = dirs.get(parts[depth])
+                if sub is None:
+                    sub = dirs[parts[depth]] = [0, hashlib.sha1()]
+                sub[0] += 1
+                sub[1].update(line)
+        return {
+            'files': hi - lo,
+            'hash': total.hexdigest(),
+            'dirs': {name: [count, h.hexdigest()]
+                     for name, (count, h) in dirs.items()},
+        }
+
+    def records(self, path="", recursive=True):
+        """Yield the records under path, sorted by path. If not recursive,
+        only the files directly in path."""
+        lo, hi = self._range(path)
+        depth = len(_key(path)) if path else 0
+        for i in range(lo, hi):
+            if recursive or len(self._keys[i]) == depth + 1:
+                yield self._records[i]
+
+    def blocks(self, path, block_size=BLOCK_SIZE):
+        """Return the checksums of the consecutive blocks of a scanned file.
+        Blocks can't be smaller than the minimum block size of the agent:
+        the checksums of tiny blocks would tell their content."""
+        if block_size < self._min_block_size:
+            raise ValueError(f"Block size {block_size} is below the minimum "
+                             f"of {self._min_block_size} bytes.")
+        i = bisect_left(self._keys, _key(path))
+        if not self._path.is_dir() or i == len(self._keys) \
+                or self._records[i].path != path:
+            raise FileNotFoundError(f"{path} was not scanned.")
+        digest = get_digest_func(self.csum_name)
+        with open(os.path.join(self._path, path), 'rb') as fp:
+            return [digest(block) for block in
+                    iter(functools.partial(fp.read, block_size), b'')]
+
+
+def _parse_address(address):
+    url = urlsplit(address)
+    if url.scheme == 'unix':
+        return socket.AF_UNIX, url.path
+    if url.scheme == 'tcp' and url.hostname is not None and url.port:
+        return socket.AF_INET, (url.hostname, url.port)
+    raise ValueError(f"Invalid agent address {address}, expected "
+                     f"tcp://host:port or unix:///path/to/socket.")
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(address, agent, token=None):
+    """
+    Answer the requests of comparisons connecting to address, one
+    connection at a time, until interrupted (SIGTERM too). Requests and responses are
+    JSON documents, one per line. Records are streamed one per line as
+    [path, size, checksum], followed by null.
+
+    The first request of a connection must hold token, if any. Without a
+    token, only local connections are possible: Unix sockets, readable by
+    the user only, or TCP on a loopback address.
+    """
+    family, addr = _parse_address(address)
+    if family == socket.AF_INET and not token and not _is_loopback(addr[0]):
+        raise ValueError(f"Serving on {address} without a token would let "
+                         f"anyone on the network query the tree: set a "
+                         f"token, or listen on a loopback address.")
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.unlink(addr)  # left over by a previous agent
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created readable by the user only, not changed once others could
+        # already connect
+        umask = os.umask(0o177)
+        try:
+            server.bind(addr)
+        finally:
+            os.umask(umask)
+        server.listen()
+    else:
+        server = socket.create_server(addr, family=socket.AF_INET6
+            if ':' in addr[0] else socket.AF_INET)
+    print(f"\nServing on {address}.")
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        with server:
+            while True:
+                conn, peer = server.accept()
+                logger.info(f"Connection from {peer or address}.")
+                with conn, conn.makefile('rb') as rfile, \
+                        conn.makefile('wb') as wfile:
+                    try:
+                        _handle(agent, rfile, wfile, token)
+                    except (ConnectionError, BrokenPipeError) as e:
+                        logger.warning(f"\nConnection lost: {e}")
+    finally:
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+
+def _send(wfile, obj):
+    wfile.write(json.dumps(obj).encode() + b'\n')
+
+def _param(request, name, kind):
+    if name not in request:
+        raise ValueError(f"Missing {name}.")
+    value = request[name]
+    if not isinstance(value, kind):
+        raise TypeError(f"{name} must be of type {kind.__name__}.")
+    return value
+
+# Answered with an error, without closing the connection
+REQUEST_ERRORS = (OSError, ValueError, KeyError, TypeError, AttributeError)
+
+def _handle(agent, rfile, wfile, token=None):
+    authenticated = not token
+    for line in rfile:
+        try:
+            request = json.loads(line)
+            op = _param(request, 'op', str) if isinstance(request, dict) \
+                else None
+            if op == 'hello':
+                # Not logged, it holds the token
+                given = request.get('token') or ""
+                if token and not hmac.compare_digest(
+                        str(given).encode(), token.encode()):
+                    logger.warning("\nConnection refused: invalid token.")
+                    _send(wfile, {'error': "Invalid token."})
+                    wfile.flush()
+                    return
+                authenticated = True
+                _send(wfile, {})
+            elif not authenticated:
+                logger.warning("\nConnection refused: no token.")
+                _send(wfile, {'error': "A token is required."})
+                wfile.flush()
+                return
+            else:
+                logger.info(f"Request: {request}")
+                _answer(agent, wfile, op, request)
+        except REQUEST_ERRORS as e:
+            logger.warning(f"\nBad request: {e!r}")
+            _send(wfile, {'error': str(e)})
+        wfile.flush()
+
+def _answer(agent, wfile, op, request):
+    if op == 'scan':
+        _send(wfile, agent.scan())
+    elif op == 'filter':
+        filters = _param(request, 'filters', list)
+        for f in filters:
+            if f is not None and not isinstance(f, dict):
+                raise TypeError("filters must be objects or null.")
+        _send(wfile, agent.filter(filters))
+    elif op == 'aggregate':
+        _send(wfile, agent.aggregate(_param(request, 'path', str)))
+    elif op == 'records':
+        # Bad paths raise before the first record is sent
+        for record in agent.records(_param(request, 'path', str),
+                                    request.get('recursive', True)):
+            _send(wfile, list(record))
+        _send(wfile, None)
+    elif op == 'blocks':
+        _send(wfile, agent.blocks(_param(request, 'path', str),
+                                  _param(request, 'block_size', int)))
+    else:
+        _send(wfile, {'error': f"Unknown request {op!r}."})
+
+
+class AgentClient:
+    """Same interface as ScanAgent, for an agent serving at address."""
+    def __init__(self, address, token=None):
+        self._address = address
+        family, addr = _parse_address(address)
+        try:
+            if family == socket.AF_UNIX:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(addr)
+            else:
+                self._sock = socket.create_connection(addr)
+        except OSError as e:
+            raise ConnectionError(f"Cannot reach agent {address}: {e}")
+        self._rfile = self._sock.makefile('rb')
+        self._wfile = self._sock.makefile('wb')
+        self._request('hello', token=token)
+        self._response()
+
+    def _request(self, op, **kwargs):
+        _send(self._wfile, {'op': op, **kwargs})
+        self._wfile.flush()
+
+    def _response(self):
+        line = self._rfile.readline()
+        if not line:
+            raise ConnectionError(f"Agent {self._address} closed the "
+                                  f"connection.")
+        response = json.loads(line)
+        if isinstance(response, dict) and 'error' in response:
+            raise OSError(f"Agent {self._address}: {response['error']}")
+        return response
+
+    def scan(self):
+        self._request('scan')
+        return self._response()
+
+    def filter(self, filters):
+        self._request('filter', filters=filters)
+        return self._response()
+
+    def aggregate(self, path):
+        self._request('aggregate', path=path)
+        return self._response()
+
+    def records(self, path="", recursive=True):
+        # Sent right away, so that both agents start streaming
+        self._request('records', path=path, recursive=recursive)
+        return self._iter_records()
+
+    def _iter_records(self):
+        while True:
+            item = self._response()
+            if item is None:
+                return
+            yield FileRecord(*item)
+
+    def blocks(self, path, block_size=BLOCK_SIZE):
+        self._request('blocks', path=path, block_size=block_size)
+        return self._response()
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self._sock.close()
+
+
+class RemoteComparison:
+    """
+    Compare two trees through agents, moving only metadata. Subtrees whose
+    aggregate hashes match are skipped, and the records of the others are
+    merge-joined while they are streamed. Files changed in place are hashed
+    again by block on both sides to locate the differences.
+    Copies of files from skipped subtrees are reported as added.
+    """
+    def __init__(self, agent1, agent2, block_size=BLOCK_SIZE,
+                 prune_size=PRUNE_SIZE):
+        self._agent1 = agent1
+        self._agent2 = agent2
+        self._block_size = block_size
+        self._prune_size = prune_size
+
+    def compare(self):
+        self._result = ComparisonResult()
+        self._streamed1, self._streamed2 = [], []  # records received
+        self._in_place = []  # same size, different checksum
+        with ThreadPoolExecutor(2) as self._pool:
+            # Both trees are scanned at the same time
+            scan1, scan2 = self._pool.map(lambda agent: agent.scan(),
+                                          (self._agent1, self._agent2))
+            if scan1['csum'] != scan2['csum']:
+                raise ValueError(f"Trees were hashed with {scan1['csum']} "
+                                 f"and {scan2['csum']}, they can't be "
+                                 f"compared.")
+            if scan1['filters'] != scan2['filters']:
+                # Both sides leave out what either side was scanned without
+                filters = [scan1['filters'], scan2['filters']]
+                scan1, scan2 = self._pool.map(
+                    lambda agent: agent.filter(filters),
+                    (self._agent1, self._agent2))
+            if scan1['hash'] != scan2['hash']:
+                self._compare_dir("", scan1, scan2)
+            # Not while records are streamed on the same connections
+            for path in self._in_place:
+                self._locate_blocks(path)
+
+        unmatched = classify_unmatched(self._streamed1, self._streamed2)
+        print_unmatched(unmatched)
+        return bool(self._result.changed or unmatched)
+
+    def _compare_dir(self, path, aggregate1, aggregate2):
+        if max(aggregate1['files'], aggregate2['files']) <= self._prune_size:
+            self._merge(self._agent1.records(path), self._agent2.records(path))
+            return
+        self._merge(self._agent1.records(path, recursive=False),
+                    self._agent2.records(path, recursive=False))
+        dirs1, dirs2 = aggregate1['dirs'], aggregate2['dirs']
+        for name in sorted(dirs1.keys() | dirs2.keys()):
+            sub1, sub2 = dirs1.get(name), dirs2.get(name)
+            if sub1 == sub2:
+                continue
+            subpath = os.path.join(path, name) if path else name
+            if sub1 is None or sub2 is None:
+                self._merge(self._agent1.records(subpath),
+                            self._agent2.records(subpath))
+            else:
+                self._compare_dir(subpath, self._agent1.aggregate(subpath),
+                                  self._agent2.aggregate(subpath))
+
+    def _merge(self, records1, records2):
+        """Match two streams of records sorted by path."""
+        records1, records2 = iter(records1), iter(records2)
+        r1, r2 = next(records1, None), next(records2, None)
+        while r1 is not None or r2 is not None:
+            k1 = _key(r1.path) if r1 is not None else None
+            k2 = _key(r2.path) if r2 is not None else None
+            if r2 is None or (r1 is not None and k1 < k2):
+                self._streamed1.append(r1)
+                r1 = next(records1, None)
+            elif r1 is None or k2 < k1:
+                self._streamed2.append(r2)
+                r2 = next(records2, None)
+            else:
+                self._compare_files(r1, r2)
+                self._streamed1.append(r1)
+                self._streamed2.append(r2)
+                r1, r2 = next(records1, None), next(records2, None)
+
+    def _compare_files(self, r1, r2):
+        if r1.checksum != r2.checksum:
+            append_to_list(self._result.changed, r1.path,
+                f"CSUM changed from {r1.checksum} to {r2.checksum}")
+            if r1.size == r2.size and r1.size > self._block_size > 0:
+                self._in_place.append(r1.path)
+        if r1.size != r2.size:
+            append_to_list(self._result.changed, r1.path,
+                f"Size changed from {r1.size} to {r2.size}")
+        changes = self._result.changed.get(r1.path)
+        if changes:
+            print(f"{r1.path} {', '.join(changes)}")
+
+    def _locate_blocks(self, path):
+        try:
+            blocks1, blocks2 = self._pool.map(
+                lambda agent: agent.blocks(path, self._block_size),
+                (self._agent1, self._agent2))
+        except (OSError, ValueError) as e:
+            logger.warning(f"\nCould not hash {path} by block: {e}")
+            return
+        offsets = [i * self._block_size for i, (b1, b2)
+                   in enumerate(zip(blocks1, blocks2)) if b1 != b2]
+        if offsets:
+            print(f"{path} {len(offsets)} blocks of {self._block_size} bytes "
+                  f"differ, first at offset {offsets[0]}")
@@ -1,8 +1,10 @@
 import os
+import threading
 import logging
-from functools import partial
 logger = logging.getLogger()
 from datetime import datetime
+from itertools import chain, repeat
+from concurrent.futures import ThreadPoolExecutor
 
 from yaml import load, dump, parse
 try:
@@ -11,29 +13,57 @@ except ImportError:
     from yaml import Dumper
 
 from .csum import *
+from .compress import open_write, EXTENSIONS
+from .compact import CompactTree, ROOT
+from .manifest import (iter_tree_records, dump_front_coded, make_header)
+from .names import NameTable
+from .extents import get_shared_extents
+from .filters import PathFilter
+
+BATCH_SIZE = 64  # files of a directory hashed per worker task
 
 #TODO we could walk the trees manually with a for k1, k2 in d1.keys(), d2.keys():
 
 class DirTreeGenerator:
-    def __init__(self, path, _args, printer):
+    tree_type = None
+    layout = None  # YAML layout written, if different from tree_type
+
+    def __init__(self, path, _args, printer, names=None):
         self._csum_name = _args.csum_name
         self.printer = printer
-        # FIXME this could be in a nested class maybe
-        if self._csum_name == 'crc32':
-            self._get_csum = get_crc32
-        elif self._csum_name == 'xxhash':
-            self._get_csum = get_xxhash
-        else:
-            self._get_csum = partial(get_hash, hashtype=self._csum_name)
+        self._get_csum = get_csum_func(self._csum_name)
+        self._digest = get_digest_func(self._csum_name)
+        self._small_size = _args.small_file_size
+        self._threads = _args.threads
+        self._pool = None
+        self._local = threading.local()  # per thread read buffer
 
         self._path = path # pathlib.Path
         self._output_dir = _args.output_dir
+        self._compression = _args.compress
+        self._front_coded = _args.front_coded
+        # Names repeat a lot across a tree, and across the trees compared
+        self._names = names if names is not None else NameTable()
+        # Also collects the rules of the ignore files met during the walk
+        self.path_filter = PathFilter.from_args(_args)
+        # Checksums of files whose data is reachable from several paths
+        self._reflinks = _args.reflinks
+        self._inodes = {}  # (st_dev, st_ino) -> checksum
+        self._extents = {}  # (st_dev, size, shared extents) -> checksum
+        self._shared_hits = 0
 
     def generate(self, no_output=False):
         # FIXME this function might not need to be in this class,
         # perhaps standalone in __main__, since all we do is a "tee" on the
         # dir_content that will be returned regardless.
-        dir_content = self._generate()
+        if self._threads > 1:
+            self._pool = ThreadPoolExecutor(self._threads)
+        try:
+            dir_content = self._generate()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
 
         if not no_output:
             filename = os.path.basename(self._path)\
@@ -42,25 +72,133 @@ class DirTreeGenerator:
             fpath = self._output_dir\
                     + os.sep\
                     + filename\
-                    + ".yaml"
-            with open(fpath, 'w') as op:
-                dump(dir_content, stream=op, Dumper=Dumper)
+                    + ".yaml"\
+                    + EXTENSIONS.get(self._compression, "")
+            with open_write(fpath, self._compression) as op:
+                if self._front_coded:
+                    dump_front_coded(
+                        iter_tree_records(dir_content, self.tree_type), op,
+                        make_header('front_coded', self._csum_name,
+                                    self.path_filter.header())
+                    )
+                else:
+                    dump(make_header(self.layout or self.tree_type,
+                                     self._csum_name,
+                                     self.path_filter.header()),
+                         stream=op, Dumper=Dumper, explicit_start=True)
+                    self._dump(dir_content, op)
             print(f"\nWrote results to YAML file: {fpath}.")
+        if self._shared_hits:
+            logger.info(f"\n{self._shared_hits} files of {self._path} were "
+                        f"hardlinks or reflinks to data already hashed.")
         return dir_content
 
+    def _dump(self, dir_content, stream):
+        dump(dir_content, stream=stream, Dumper=Dumper, explicit_start=True)
+
+    def _filter(self, root, dirs, files):
+        """Drop the filtered out entries of root, before they are stat'ed."""
+        reldir = os.path.relpath(root, self._path)
+        return self.path_filter.filter_entries(
+            root, "" if reldir == os.curdir else reldir, dirs, files)
+
+    def _hash_files(self, root, files):
+        """
+        Yield (filename, size, checksum) for the files of directory root, in
+        order. Files we can't read get a size and checksum of 0, files we
+        have no permission on are skipped.
+        Large directories are hashed in batches on the thread pool.
+        """
+        if self._pool is None or len(files) <= BATCH_SIZE:
+            results = self._hash_batch(root, files)
+        else:
+            batches = [files[i:i + BATCH_SIZE]
+                       for i in range(0, len(files), BATCH_SIZE)]
+            results = chain.from_iterable(
+                self._pool.map(self._hash_batch, repeat(root), batches))
+        for f, info in zip(files, results):
+            if isinstance(info, OSError):
+                logger.critical(f"\n{info}")
+                if isinstance(info, PermissionError):
+                    continue
+                info = (0, 0)
+            yield f, *info
+
+    def _hash_batch(self, root, files):
+        """
+        Return (size, checksum), or the OSError raised, for each file.
+        Files smaller than --small_file_size are read with a single call into
+        a buffer reused by the thread, and hashed at once.
+        """
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(self._small_size)
+        prefix = root + os.sep
+        results = []
+        for f in files:
+            fpath = prefix + f
+            try:
+                st = os.stat(fpath)
+                # Small files are cheaper to hash again than to look up in
+                # the hardlink and reflink caches
+                data = read_small_file(fpath, buf) \
+                    if st.st_size < self._small_size else None
+                if data is None:
+                    results.append(self._stat_and_hash(fpath, st))
+                    continue
+                if st.st_size == 0:
+                    logger.warning(f"\nFile {fpath} is 0 length bytes!")
+                results.append((st.st_size, self._digest(data)))
+            except OSError as e:
+                results.append(e)
+        return results
+
+    def _stat_and_hash(self, fpath, st=None):
+        """Return size and checksum of fpath, hashing the data of hardlinked
+        (and optionally reflinked) files only once."""
+        if st is None:
+            st = os.stat(fpath)
+        sz = st.st_size
+        if sz == 0:
+            logger.warning(f"\nFile {fpath} is {sz} length bytes!")
+
+        keys = []
+        if st.st_nlink > 1:
+            keys.append((self._inodes, (st.st_dev, st.st_ino)))
+        if self._reflinks and sz:
+            extents = get_shared_extents(fpath)
+            if extents is not None:
+                keys.append((self._extents, (st.st_dev, sz, extents)))
+
+        for cache, key in keys:
+            csum = cache.get(key)
+            if csum is not None:
+                self._shared_hits += 1
+                break
+        else:
+            csum = self._get_csum(fpath)
+        for cache, key in keys:
+            cache[key] = csum
+        return sz, csum
+
+    def _intern(self, names):
+        return [self._names.intern(name) for name in names]
+
     # Virtual
     def _generate(self):
         raise NotImplementedError()
     def _recursive_stat(self, base_path):
         raise NotImplementedError()
-    def _get_file_info(self, root, filename):
+    def _get_file_info(self, filename, sz, cs):
         raise NotImplementedError()
 
 
 class DirTreeGeneratorMixed(DirTreeGenerator):
     """Default implementation uses Dicts, and Lists for directory content."""
-    def __init__(self, path, args, printer):
-        super().__init__(path, args, printer)
+    tree_type = 'mixed_dict'
+
+    def __init__(self, path, args, printer, names=None):
+        super().__init__(path, args, printer, names)
 
     def _generate(self):
         """Return dictionary representing dir tree structure."""
@@ -79,7 +217,9 @@ class DirTreeGeneratorMixed(DirTreeGenerator):
             return directory
 
         for root, dirs, files in os.walk(base_path):
-            dn = os.path.basename(root)
+            dirs, files = self._filter(root, dirs, files)
+            dirs, files = self._intern(dirs), self._intern(files)
+            dn = self._names.intern(os.path.basename(root))
             directory[dn] = []
             if dirs:
                 for d in dirs:
@@ -90,37 +230,17 @@ class DirTreeGeneratorMixed(DirTreeGenerator):
                         base_path=os.path.join(base_path, d)
                         )
                     )
-                for f in files:
-                    try:
-                        directory[dn].append(self._get_file_info(root, f))
-                    except PermissionError as e:
-                        logger.critical(f"\n{e}")
-                        continue
-                    except OSError as e:
-                        logger.critical(f"\n{e}")
-                        directory[dn].append({'n': f, 'cs': 0, 'sz': 0})
-                        continue
+                for f, sz, cs in self._hash_files(root, files):
+                    directory[dn].append(self._get_file_info(f, sz, cs))
             elif files:
                 # directory[dn].append([self.get_file_info(root, f) for f in files])
-                for f in files:
-                    try:
-                        directory[dn].append(self._get_file_info(root, f))
-                    except PermissionError as e:
-                        logger.critical(f"\n{e}")
-                        continue
-                    except OSError as e:
-                        logger.critical(f"\n{e}")
-                        directory[dn].append({'n': f, 'cs': 0, 'sz': 0})
-                        continue
+                for f, sz, cs in self._hash_files(root, files):
+                    directory[dn].append(self._get_file_info(f, sz, cs))
             return directory
 
-    def _get_file_info(self, root, filename): # dict
-        fpath = os.path.join(root, filename)
-        sz = os.stat(fpath).st_size
-        if sz == 0:
-            logger.warning(f"\nFile {fpath} is {sz} length bytes!")
+    def _get_file_info(self, filename, sz, cs): # dict
         return { 'n': filename,
-                'cs': self._get_csum(fpath),
+                'cs': cs,
                 'sz': sz
         }
         # return { filename: {
@@ -132,8 +252,10 @@ class DirTreeGeneratorMixed(DirTreeGenerator):
 
 class DirTreeGeneratorPureDict(DirTreeGenerator):
     """Default implementation uses nested Dicts only."""
-    def __init__(self, path, args, printer):
-        super().__init__(path, args, printer)
+    tree_type = 'pure_dict'
+
+    def __init__(self, path, args, printer, names=None):
+        super().__init__(path, args, printer, names)
 
     def _generate(self):
         """Return dictionary representing dir tree structure."""
@@ -151,6 +273,8 @@ class DirTreeGeneratorPureDict(DirTreeGenerator):
             return directory
 
         for root, dirs, files in os.walk(base_path):
+            dirs, files = self._filter(root, dirs, files)
+            dirs, files = self._intern(dirs), self._intern(files)
             # dn = os.path.basename(root)
             # directory[dn] = {}
             if dirs:
@@ -161,44 +285,26 @@ class DirTreeGeneratorPureDict(DirTreeGenerator):
                     directory[d] = self._recursive_stat(
                         base_path=os.path.join(base_path, d)
                     )
-                for f in files:
-                    try:
-                        directory[f] = self._get_file_info(root, f)
-                    except PermissionError as e:
-                        logger.critical(f"\n{e}")
-                        continue
-                    except OSError as e:
-                        logger.critical(f"\n{e}")
-                        directory[f] = {'cs': 0, 'sz': 0}
-                        continue
+                for f, sz, cs in self._hash_files(root, files):
+                    directory[f] = self._get_file_info(f, sz, cs)
             elif files:
-                for f in files:
-                    try:
-                        directory[f] = self._get_file_info(root, f)
-                    except PermissionError as e:
-                        logger.critical(f"\n{e}")
-                        continue
-                    except OSError as e:
-                        logger.critical(f"\n{e}")
-                        directory[f] = {'cs': 0, 'sz': 0}
-                        continue
+                for f, sz, cs in self._hash_files(root, files):
+                    directory[f] = self._get_file_info(f, sz, cs)
             return directory
 
-    def _get_file_info(self, root, filename): # dict
-        fpath = os.path.join(root, filename)
-        sz = os.stat(fpath).st_size
-        if sz == 0:
-            logger.warning(f"\nFile {fpath} is {sz} length bytes!")
+    def _get_file_info(self, filename, sz, cs): # dict
         return {
-                'cs': self._get_csum(fpath),
-                'sz': os.stat(fpath).st_size
+                'cs': cs,
+                'sz': sz
         }
 
 
 class DirTreeGeneratorPureList(DirTreeGeneratorMixed):
     """Implementation around Lists."""
-    def __init__(self, path, args, printer):
-        super().__init__(path, args, printer)
+    tree_type = 'pure_list'
+
+    def __init__(self, path, args, printer, names=None):
+        super().__init__(path, args, printer, names)
 
     def _generate(self):
         """Returns List of Lists representing dir tree structure."""
@@ -215,7 +321,9 @@ class DirTreeGeneratorPureList(DirTreeGeneratorMixed):
             return directory
 
         for root, dirs, files in os.walk(base_path):
-            dn = os.path.basename(root)
+            dirs, files = self._filter(root, dirs, files)
+            dirs, files = self._intern(dirs), self._intern(files)
+            dn = self._names.intern(os.path.basename(root))
             directory.append(dn)
             if dirs:
                 for d in dirs:
@@ -226,34 +334,52 @@ class DirTreeGeneratorPureList(DirTreeGeneratorMixed):
                         self._recursive_stat(base_path=os.path.join(base_path, d)
                         )
                     )
-                for f in files:
-                    try:
-                        directory.append(self._get_file_info(root, f))
-                    except PermissionError as e:
-                        logger.critical(f"\n{e}")
-                        continue
-                    except OSError as e:
-                        logger.critical(f"\n{e}")
-                        directory.append([f, 0, 0])
-                        continue
+                for f, sz, cs in self._hash_files(root, files):
+                    directory.append(self._get_file_info(f, sz, cs))
             elif files:
-                children = []
-                for f in files:
-                    try:
-                        children.append(self._get_file_info(root, f))
-                    except PermissionError as e:
-                        logger.critical(f"\n{e}")
-                        continue
-                    except OSError as e:
-                        logger.critical(f"\n{e}")
-                        children.append([f, 0, 0])
-                        continue
-                directory.append(children)
+                directory.append([self._get_file_info(f, sz, cs)
+                                  for f, sz, cs in self._hash_files(root, files)])
             return directory
 
-    def _get_file_info(self, root, filename):
-        fpath = os.path.join(root, filename)
-        sz = os.stat(fpath).st_size
-        if sz == 0:
-            logger.warning(f"\nFile {fpath} is {sz} length bytes!")
-        return [filename, self._get_csum(fpath), sz]
+    def _get_file_info(self, filename, sz, cs):
+        return [filename, cs, sz]
+
+
+class DirTreeGeneratorCompact(DirTreeGenerator):
+    """
+    Implementation around a CompactTree: columnar arrays of name ids, parent
+    ids, sizes and raw digests. Written to YAML in the mixed_dict layout.
+    """
+    tree_type = 'compact'
+    layout = 'mixed_dict'
+
+    def __init__(self, path, args, printer, names=None):
+        super().__init__(path, args, printer, names)
+
+    def _generate(self):
+        """Returns CompactTree representing dir tree structure."""
+        tree = CompactTree(self._csum_name, self._names)
+        self._recursive_stat(self._path, tree, ROOT)
+        return tree
+
+    def _dump(self, dir_content, stream):
+        dir_content.dump(stream)
+
+    def _recursive_stat(self, base_path, tree, parent):
+        if not os.access(base_path, os.R_OK):
+            return
+
+        for root, dirs, files in os.walk(base_path):
+            dirs, files = self._filter(root, dirs, files)
+            for d in dirs:
+                dirname = os.path.join(base_path, d)
+                logger.info(f"Scanning {dirname}...")
+                self.printer.update(id(self), dirname)
+                self._recursive_stat(
+                    base_path=os.path.join(base_path, d),
+                    tree=tree,
+                    parent=tree.add_dir(parent, d)
+                )
+            for f, sz, cs in self._hash_files(root, files):
+                tree.add_file(parent, f, sz, cs)
+            return
@@ -0,0 +1,394 @@
+import os
+import sys
+import stat
+import time
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import logging
+logger = logging.getLogger()
+from collections import deque
+
+from .csum import get_csum_func
+from .compress import open_write, EXTENSIONS
+from .manifest import (FileRecord, iter_manifest, dump_front_coded,
+                       make_header, HEADER_KEY)
+from .filters import PathFilter, filter_records, excluded_with_parents
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# No IN_ATTRIB: chmod, chown or touch don't write data, and must not let
+# a corrupted file be accepted as written
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM \
+    | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+    | IN_ONLYDIR | IN_DONT_FOLLOW
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+READ_SIZE = 1 << 16
+
+
+class Inotify:
+    """Minimal inotify(7) binding through ctypes."""
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(f"inotify is not available on {sys.platform}.")
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._libc.inotify_add_watch.argtypes = \
+            (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails harmlessly if the kernel already removed the watch
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Return a list of (wd, mask, cookie, name) once events are
+        available, or an empty list after timeout seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TreeWatcher:
+    """
+    Keep the manifest of a tree up to date from inotify events.
+
+    Files written, created or moved since the last manifest are marked dirty,
+    and only those are hashed again every interval seconds. Between updates,
+    up to scrub files that were not written are hashed again as well: their
+    checksum is not expected to change, so any difference is reported as
+    possible silent data corruption.
+    """
+    def __init__(self, path, args, manifest=None):
+        self._root = os.fspath(path)
+        self._csum_name = args.csum_name
+        self._get_csum = get_csum_func(self._csum_name)
+        self._interval = args.interval
+        self._scrub = args.scrub
+        self._compression = args.compress
+        self._filter = PathFilter.from_args(args)
+        self._fpath = os.path.join(args.output_dir,
+            os.path.basename(os.path.normpath(self._root))
+            + "_hashes_watch.yaml" + EXTENSIONS.get(self._compression, ""))
+
+        self.records = {}  # path -> FileRecord, the manifest
+        self.dirty = set()  # paths written since the last update
+        self.written = set()  # paths legitimately written since the baseline
+        self._gone_dirs = set()  # directories deleted or moved away
+        self._moved_dirs = {}  # cookie -> path of directory moved away
+        self._ignore_dirs = set()  # directories whose ignore file changed
+        self._watches = {}  # wd -> directory path
+        self._scrub_queue = deque()
+        self._verify = set()  # paths whose events may have been lost
+        self._reported = {}  # path -> FileRecord reported as corrupted
+        self._last_update = None  # time the last update started
+
+        self._inotify = Inotify()
+        # Watches are set before the baseline is read, so that no write
+        # can be missed in between.
+        if manifest is not None:
+            self._load_baseline(manifest)
+        else:
+            self.dirty.update(self._add_watches(""))
+            logger.info(f"Hashing {len(self.dirty)} files under {self._root}...")
+            self.update()
+            self.written.clear()  # the initial scan is the baseline
+
+    def _load_baseline(self, manifest):
+        """Start from an existing manifest: files modified after it was
+        written are dirty."""
+        self._last_update = os.stat(manifest).st_mtime
+        files = self._add_watches("")
+        self.records = {r.path: r for r in filter_records(
+            iter_manifest(manifest), self._filter.excluded)}
+        self._mark_modified(files)
+        logger.info(f"Loaded {len(self.records)} files from {manifest}, "
+                    f"{len(self.dirty)} changed since.")
+
+    def _mark_modified(self, files):
+        """
+        Without events, tell written files from the others by their mtime:
+        files modified since the last update, new files and files gone are
+        dirty. The ctime is not used, as it also changes with chmod.
+        Return the other files.
+        """
+        unmodified = []
+        for path in files:
+            try:
+                st = os.lstat(os.path.join(self._root, path))
+            except OSError:
+                st = None
+            if st is None or st.st_mtime > self._last_update \
+                    or path not in self.records:
+                self.dirty.add(path)
+            else:
+                unmodified.append(path)
+        files = set(files)
+        self.dirty.update(p for p in self.records if p not in files)
+        return unmodified
+
+    def _add_watches(self, dirpath):
+        """Watch dirpath and its subdirectories, return the paths of their
+        files."""
+        paths = []
+        for root, dirs, files in os.walk(os.path.join(self._root, dirpath)):
+            rel = os.path.relpath(root, self._root)
+            rel = "" if rel == os.curdir else rel
+            # Excluded directories are neither watched nor walked
+            dirs[:], files = self._filter.filter_entries(root, rel, dirs, files)
+            try:
+                self._watches[self._inotify.add_watch(root)] = rel
+            except OSError as e:
+                # ENOSPC: fs.inotify.max_user_watches is too low
+                logger.critical(f"\nCannot watch {root}: {e}")
+            paths.extend(os.path.join(rel, f) if rel else f for f in files)
+        return paths
+
+    def run(self):
+        """Process events until interrupted, updating the manifest every
+        interval seconds. SIGTERM stops it like SIGINT does."""
+        signal.signal(signal.SIGTERM, _interrupt)
+        next_update = time.monotonic() + self._interval
+        try:
+            while True:
+                timeout = max(0, next_update - time.monotonic())
+                self._read_events(timeout)
+                if time.monotonic() >= next_update:
+                    self.update()
+                    self.scrub()
+                    next_update = time.monotonic() + self._interval
+        except KeyboardInterrupt:
+            self.update()
+        finally:
+            self._inotify.close()
+
+    def _read_events(self, timeout):
+        for wd, mask, cookie, name in self._inotify.read(timeout):
+            self._handle(wd, mask, cookie, name)
+        # Directories moved out of the tree are not watched anymore
+        for path in self._moved_dirs.values():
+            self._unwatch(path)
+        self._moved_dirs.clear()
+
+    def _handle(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("\ninotify queue overflowed, rescanning the tree.")
+            self._rescan()
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+
+        dirpath = self._watches.get(wd)
+        if dirpath is None or not name:
+            return
+        path = os.path.join(dirpath, name) if dirpath else name
+        if name == self._filter.ignore_file and not mask & IN_ISDIR:
+            self._ignore_dirs.add(dirpath)
+            return
+        if self._filter.excluded(path, bool(mask & IN_ISDIR)):
+            return
+
+        if not mask & IN_ISDIR:
+            # Anything but reads and deletions means the data may be new
+            self.dirty.add(path)
+        elif mask & IN_MOVED_FROM:
+            self._moved_dirs[cookie] = path
+            self._gone_dirs.add(path)
+        elif mask & IN_MOVED_TO and cookie in self._moved_dirs:
+            self._rename_dir(self._moved_dirs.pop(cookie), path)
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            self.dirty.update(self._add_watches(path))
+        elif mask & IN_DELETE:
+            self._gone_dirs.add(path)
+
+    def _rename_dir(self, old, new):
+        """A directory moved within the tree keeps its watches and hashes."""
+        self._gone_dirs.discard(old)
+        old_prefix, new_prefix = old + os.sep, new + os.sep
+        for wd, path in self._watches.items():
+            if path == old:
+                self._watches[wd] = new
+            elif path.startswith(old_prefix):
+                self._watches[wd] = new_prefix + path[len(old_prefix):]
+        for collection in (self.records, self.dirty, self.written):
+            for path in [p for p in collection if p.startswith(old_prefix)]:
+                new_path = new_prefix + path[len(old_prefix):]
+                if collection is self.records:
+                    record = self.records.pop(path)
+                    self.records[new_path] = record._replace(path=new_path)
+                else:
+                    collection.discard(path)
+                    collection.add(new_path)
+
+    def _unwatch(self, dirpath):
+        prefix = dirpath + os.sep
+        for wd, path in list(self._watches.items()):
+            if path == dirpath or path.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+
+    def _rescan(self):
+        """After events were lost, files not modified since the last update
+        are all hashed again at the next scrub, to report any change."""
+        for wd in list(self._watches):
+            self._inotify.rm_watch(wd)
+        self._watches.clear()
+        self._verify.update(self._mark_modified(self._add_watches("")))
+
+    def update(self):
+        """Hash dirty files again and write the manifest."""
+        self._last_update = time.time()
+        for dirpath in self._gone_dirs:
+            if os.path.isdir(os.path.join(self._root, dirpath)):
+                continue
+            prefix = dirpath + os.sep
+            for path in [p for p in self.records if p.startswith(prefix)]:
+                del self.records[path]
+                self.written.discard(path)
+                self._reported.pop(path, None)
+        self._gone_dirs.clear()
+        for dirpath in sorted(self._ignore_dirs):
+            self._reload_ignore_file(dirpath)
+        self._ignore_dirs.clear()
+
+        count = len(self.dirty)
+        while self.dirty:
+            path = self.dirty.pop()
+            self._reported.pop(path, None)
+            record = self._hash(path)
+            if record is None:
+                self.records.pop(path, None)
+                self.written.discard(path)
+            else:
+                self.records[path] = record
+                self.written.add(path)
+        logger.info(f"Hashed {count} dirty files.")
+        self._write()
+
+    def _reload_ignore_file(self, dirpath):
+        """Apply the rules of an ignore file created, written or deleted:
+        files they now exclude are dropped, and files they no longer
+        exclude are hashed."""
+        self._filter.load_ignore_file(os.path.join(self._root, dirpath),
+                                      dirpath)
+        excluded = excluded_with_parents(self._filter.excluded)
+        prefix = dirpath + os.sep if dirpath else ""
+        for path in [p for p in self.records if p.startswith(prefix)]:
+            if excluded(path):
+                del self.records[path]
+                self.written.discard(path)
+        self.dirty = {p for p in self.dirty
+                      if not p.startswith(prefix) or not excluded(p)}
+        self.dirty.update(p for p in self._add_watches(dirpath)
+                          if p not in self.records)
+
+    def scrub(self):
+        """Hash again files that were not written, and report those whose
+        checksum changed anyway. All the files whose events may have been
+        lost are checked, on top of the scrub quota."""
+        while self._verify:
+            self._check(self._verify.pop())
+        for _ in range(min(self._scrub, len(self.records))):
+            if not self._scrub_queue:
+                self._scrub_queue.extend(sorted(self.records))
+            self._check(self._scrub_queue.popleft())
+
+    def _check(self, path):
+        known = self.records.get(path)
+        if known is None or path in self.dirty:
+            return
+        record = self._hash(path)
+        if record is None or record == known:
+            self._reported.pop(path, None)
+            return
+        # Reported once, until it is written or changes again
+        if self._reported.get(path) == record:
+            return
+        # The file may just have been written, and the event not read yet
+        self._read_events(0)
+        if path in self.dirty:
+            return
+        self._reported[path] = record
+        logger.critical(f"\n{path} changed without being written: "
+                        f"CSUM {known.checksum} -> {record.checksum}, "
+                        f"size {known.size} -> {record.size}. "
+                        f"Possible silent data corruption!")
+
+    def _hash(self, path):
+        """Return a FileRecord for path, or None if it's not a regular file."""
+        fpath = os.path.join(self._root, path)
+        try:
+            st = os.lstat(fpath)
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            return FileRecord(path, st.st_size, self._get_csum(fpath))
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.critical(f"\n{e}")
+            return FileRecord(path, 0, 0)
+
+    def _header(self):
+        header = make_header('front_coded', self._csum_name,
+                             self._filter.header())
+        header[HEADER_KEY]['written'] = sorted(self.written)
+        return header
+
+    def _write(self):
+        # Replace the manifest atomically, it may be read at any time
+        tmp = self._fpath + ".tmp"
+        with open_write(tmp, self._compression) as op:
+            dump_front_coded(self.records.values(), op, self._header())
+        os.replace(tmp, self._fpath)
+        logger.info(f"Wrote {len(self.records)} files to {self._fpath}.")
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
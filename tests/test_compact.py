@@ -0,0 +1,85 @@
+import io
+import os
+import hashlib
+import unittest
+
+from sdc_detector.manifest import FileRecord, iter_records
+from sdc_detector.compact import CompactTree, guess_csum
+from sdc_detector.names import NameTable
+
+
+def sha1_records(*paths):
+    return [FileRecord(os.path.join(*path.split('/')), len(path),
+                       hashlib.sha1(path.encode()).hexdigest())
+            for path in paths]
+
+
+class CompactTreeTest(unittest.TestCase):
+
+    def _round_trip(self, records, csum_name='sha1'):
+        tree = CompactTree.from_records(records, csum_name)
+        stream = io.StringIO()
+        tree.dump(stream)
+        stream.seek(0)
+        return CompactTree.from_records(iter_records(stream, 'mixed_dict'),
+                                        csum_name)
+
+    def test_dump_load(self):
+        records = sha1_records('a', 'd/b', 'd/e/c', 'd/e/f/g', 'd/h', 'i/j',
+                               '123', 'null')
+        tree = self._round_trip(records)
+        self.assertEqual(list(tree.records()), records)
+        # Entries are in depth-first order: a, d, d/b, d/e, d/e/c...
+        self.assertEqual(tree.path(4), os.path.join('d', 'e', 'c'))
+
+    def test_unreadable(self):
+        # Files that could not be read have a 0 checksum
+        records = sha1_records('a', 'b')
+        records[0] = records[0]._replace(checksum=0)
+        self.assertEqual(list(self._round_trip(records).records()), records)
+
+    def test_crc32(self):
+        # crc32 checksums are not zero padded
+        records = [FileRecord('a', 1, 'ff'), FileRecord('b', 2, 'ffffffff')]
+        self.assertEqual(list(self._round_trip(records, 'crc32').records()),
+                         records)
+
+    def test_file_keys(self):
+        names = NameTable()
+        tree1 = CompactTree.from_records(sha1_records('d/a', 'e/a'),
+                                         names=names)
+        tree2 = CompactTree.from_records(sha1_records('e/a', 'd/b'),
+                                         names=names)
+        dir_ids = {}
+        keys1 = dict(tree1.file_keys(dir_ids))
+        keys2 = dict(tree2.file_keys(dir_ids))
+        # Only e/a is found at the same path
+        self.assertEqual([tree1.path(keys1[k]) for k in keys1.keys() & keys2],
+                         [os.path.join('e', 'a')])
+
+    def test_wrong_csum(self):
+        sha256 = hashlib.sha256(b'').hexdigest()
+        with self.assertRaises(ValueError):
+            CompactTree.from_records([FileRecord('a', 1, sha256)], 'sha1')
+
+
+class GuessCsumTest(unittest.TestCase):
+
+    def test_lengths(self):
+        for csum_name in ('md5', 'sha1', 'sha256', 'blake2b'):
+            with self.subTest(csum_name):
+                checksum = hashlib.new(csum_name, b'data').hexdigest()
+                self.assertEqual(guess_csum([FileRecord('a', 4, checksum)]),
+                                 csum_name)
+        self.assertEqual(guess_csum([FileRecord('a', 4, 'ab12')]), 'crc32')
+
+    def test_no_checksum(self):
+        # Unreadable files are skipped
+        self.assertEqual(guess_csum([FileRecord('a', 0, 0),
+                                     FileRecord('b', 1, 'a' * 40)]), 'sha1')
+        self.assertIsNone(guess_csum([FileRecord('a', 0, 0)]))
+        self.assertIsNone(guess_csum([FileRecord('a', 1, 'a' * 42)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import os
+import tempfile
+import unittest
+
+from sdc_detector.manifest import FileRecord
+from sdc_detector.filters import (Matcher, PathFilter, prune_tree, rule_error,
+                                  excluded_by_any, filter_records)
+
+
+def swap_files(relpath, is_dir=False):
+    return relpath.endswith('.swp')
+
+
+def join(path):
+    return os.path.join(*path.split('/'))
+
+
+class MatcherTest(unittest.TestCase):
+
+    def test_names(self):
+        # Globs without a "/" match names, at any depth
+        matcher = Matcher(['*.swp', 'cache'])
+        self.assertTrue(matcher.match('d/a.swp', 'a.swp'))
+        self.assertTrue(matcher.match('d/cache', 'cache', True))
+        self.assertFalse(matcher.match('d/cache2', 'cache2'))
+
+    def test_paths(self):
+        # Globs with a "/" match the whole path, from the root
+        matcher = Matcher(['/build', 'd/*.o', 'logs/'])
+        self.assertTrue(matcher.match('build', 'build', True))
+        self.assertFalse(matcher.match('x/build', 'build', True))
+        self.assertTrue(matcher.match('d/a.o', 'a.o'))
+        self.assertFalse(matcher.match('e/d/a.o', 'a.o'))
+        # Trailing slashes are dropped, the rule matches files too
+        self.assertTrue(matcher.match('logs', 'logs'))
+
+    def test_regex(self):
+        matcher = Matcher(['re:^scratch/', r're:\.tmp$'])
+        # Searched in the path, directories also match with a "/" appended
+        self.assertTrue(matcher.match('scratch', 'scratch', True))
+        self.assertFalse(matcher.match('scratch', 'scratch'))
+        self.assertFalse(matcher.match('d/scratch', 'scratch', True))
+        self.assertTrue(matcher.match('d/e/a.tmp', 'a.tmp'))
+        self.assertFalse(matcher.match('a.tmp2', 'a.tmp2'))
+
+    def test_empty(self):
+        self.assertFalse(Matcher([]).match('a', 'a'))
+
+
+class PathFilterTest(unittest.TestCase):
+
+    def test_include_exclude(self):
+        path_filter = PathFilter(exclude=['skip'], include=['*.txt'])
+        self.assertFalse(path_filter.excluded('a.txt'))
+        self.assertTrue(path_filter.excluded('a.bin'))
+        # Exclude rules win, include rules only apply to files
+        self.assertTrue(path_filter.excluded(join('d/skip')))
+        self.assertTrue(path_filter.excluded('skip', True))
+        self.assertFalse(path_filter.excluded('d', True))
+
+    def test_empty(self):
+        path_filter = PathFilter()
+        self.assertFalse(path_filter)
+        self.assertIsNone(path_filter.header())
+        self.assertFalse(path_filter.excluded('a'))
+        # Ignore files are never hashed
+        self.assertTrue(path_filter.excluded(join('d/.sdcignore')))
+
+    def test_ignore_file_scope(self):
+        path_filter = PathFilter(ignored={join('d'): ['*.o', 'e/f']})
+        self.assertTrue(path_filter)
+        self.assertTrue(path_filter.excluded(join('d/a.o')))
+        self.assertTrue(path_filter.excluded(join('d/x/a.o')))
+        # Only below the directory of the ignore file
+        self.assertFalse(path_filter.excluded('a.o'))
+        self.assertFalse(path_filter.excluded(join('dd/a.o')))
+        # Paths are relative to that directory
+        self.assertTrue(path_filter.excluded(join('d/e/f')))
+        self.assertFalse(path_filter.excluded(join('e/f')))
+
+    def test_filter_entries(self):
+        path_filter = PathFilter(exclude=['tmp'])
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, '.sdcignore'), 'w') as fp:
+                fp.write('# comment\n\n*.o\n')
+            dirs, files = path_filter.filter_entries(
+                tmp, 'd', ['tmp', 'src'], ['a.o', 'a.c', '.sdcignore'])
+            self.assertEqual((dirs, files), (['src'], ['a.c']))
+            self.assertEqual(path_filter.ignored, {'d': ['*.o']})
+            # Reloaded when changed
+            os.remove(os.path.join(tmp, '.sdcignore'))
+            path_filter.load_ignore_file(tmp, 'd')
+        self.assertEqual(path_filter.ignored, {})
+        self.assertFalse(path_filter.excluded(join('d/a.o')))
+
+    def test_header(self):
+        path_filter = PathFilter(['*.swp'], ['re:x'], '.ignore', {'d': ['o']})
+        copy = PathFilter.from_header(path_filter.header())
+        self.assertEqual(copy.header(), path_filter.header())
+        self.assertFalse(PathFilter.from_header(None))
+
+
+class FilterRecordsTest(unittest.TestCase):
+
+    def test_parents(self):
+        # Records of excluded directories are left out with them
+        excluded = excluded_by_any([PathFilter(exclude=['re:^d/$']),
+                                    PathFilter(exclude=['*.o']), None])
+        records = [FileRecord(join(p), 1, 'x')
+                   for p in ('a', 'a.o', 'd/b', 'd/e/c', 'dd/f')]
+        self.assertEqual([r.path for r in filter_records(records, excluded)],
+                         [join('a'), join('dd/f')])
+
+
+class PruneTreeTest(unittest.TestCase):
+
+    def test_layouts(self):
+        trees = {
+            'mixed_dict': {'root': [
+                {'d': [{'n': 'b', 'sz': 1, 'cs': 'x'}]},
+                {'n': 'a', 'sz': 1, 'cs': 'x'},
+                {'n': 'a.swp', 'sz': 1, 'cs': 'x'}]},
+            'pure_dict': {
+                'd': {'b': {'sz': 1, 'cs': 'x'}},
+                'a': {'sz': 1, 'cs': 'x'},
+                'a.swp': {'sz': 1, 'cs': 'x'}},
+            'pure_list': ['root', ['d', [['b', 'x', 1]]],
+                          ['a', 'x', 1], ['a.swp', 'x', 1]],
+        }
+        expected = {
+            'mixed_dict': {'root': [{'n': 'a', 'sz': 1, 'cs': 'x'}]},
+            'pure_dict': {'a': {'sz': 1, 'cs': 'x'}},
+            'pure_list': ['root', ['a', 'x', 1]],
+        }
+        excluded = PathFilter(exclude=['d', '*.swp']).excluded
+        for tree_type, tree in trees.items():
+            with self.subTest(tree_type):
+                self.assertEqual(prune_tree(tree, tree_type, excluded),
+                                 expected[tree_type])
+
+    def test_mixed_unreadable_dir(self):
+        # Directories that can't be read are left as empty placeholders
+        tree = {'root': [{}, {'d': [{}, {'n': 'a', 'sz': 1, 'cs': 'x'},
+                                    {'n': 'a.swp', 'sz': 1, 'cs': 'y'}]}]}
+        self.assertEqual(prune_tree(tree, 'mixed_dict', swap_files),
+            {'root': [{}, {'d': [{}, {'n': 'a', 'sz': 1, 'cs': 'x'}]}]})
+
+
+class InvalidRulesTest(unittest.TestCase):
+
+    def test_rule_error(self):
+        self.assertIsNone(rule_error('*.swp'))
+        self.assertIsNone(rule_error('re:^scratch/'))
+        self.assertIsNotNone(rule_error('re:('))
+        # Flags can't be set in the middle of the combined expression
+        self.assertIsNotNone(rule_error('re:(?i)tmp'))
+
+    def test_header(self):
+        with self.assertLogs(level='CRITICAL'):
+            path_filter = PathFilter.from_header({
+                'exclude': ['re:(', '*.swp'], 'include': [],
+                'ignore_file': '.sdcignore', 'ignored': {'d': ['re:)']}})
+        self.assertEqual(path_filter.exclude, ['*.swp'])
+        self.assertTrue(path_filter.excluded('a.swp'))
+        self.assertFalse(path_filter.excluded(os.path.join('d', 'a')))
+
+    def test_ignore_file(self):
+        path_filter = PathFilter()
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, '.sdcignore'), 'w') as fp:
+                fp.write('re:(\n*.swp\n')
+            with self.assertLogs(level='CRITICAL'):
+                path_filter.load_ignore_file(tmp, 'd')
+        self.assertEqual(path_filter.ignored, {'d': ['*.swp']})
+        self.assertTrue(path_filter.excluded(os.path.join('d', 'a.swp')))
+
+
+if __name__ == '__main__':
+    unittest.main()
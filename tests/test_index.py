@@ -0,0 +1,70 @@
+import os
+import unittest
+
+from sdc_detector.manifest import FileRecord
+from sdc_detector.index import (classify_unmatched, find_duplicates,
+                                MOVED, RENAMED, MOVED_RENAMED, DUPLICATED,
+                                MISSING, ADDED)
+
+
+def records(*files):
+    return [FileRecord(os.path.join(*path.split('/')), size, checksum)
+            for path, size, checksum in files]
+
+
+def paths(*kinds):
+    return [(kind, p1 and os.path.join(*p1.split('/')),
+             p2 and os.path.join(*p2.split('/'))) for kind, p1, p2 in kinds]
+
+
+class ClassifyUnmatchedTest(unittest.TestCase):
+
+    def test_identical(self):
+        files = records(('a', 1, 'x'), ('d/b', 2, 'y'))
+        self.assertEqual(classify_unmatched(files, files), [])
+
+    def test_moves(self):
+        self.assertEqual(classify_unmatched(
+            records(('d/a', 1, 'x'), ('d/b', 2, 'y'), ('d/c', 3, 'z')),
+            records(('e/a', 1, 'x'), ('d/b2', 2, 'y'), ('e/c2', 3, 'z'))),
+            paths((MOVED, 'd/a', 'e/a'), (RENAMED, 'd/b', 'd/b2'),
+                  (MOVED_RENAMED, 'd/c', 'e/c2')))
+
+    def test_missing_and_added(self):
+        # Same checksum but another size is other content
+        self.assertEqual(classify_unmatched(
+            records(('a', 1, 'x'), ('b', 2, 'y')),
+            records(('b', 2, 'y'), ('c', 3, 'x'))),
+            paths((MISSING, 'a', None), (ADDED, None, 'c')))
+
+    def test_duplicated(self):
+        self.assertEqual(classify_unmatched(
+            records(('a', 1, 'x')),
+            records(('a', 1, 'x'), ('d/copy', 1, 'x'))),
+            paths((DUPLICATED, 'a', 'd/copy')))
+
+    def test_move_preferred(self):
+        # One of the copies is paired with the original, preferably the one
+        # keeping its name, the other is a duplicate
+        self.assertEqual(classify_unmatched(
+            records(('d/a', 1, 'x')),
+            records(('e/other', 1, 'x'), ('e/a', 1, 'x'))),
+            paths((MOVED, 'd/a', 'e/a'), (DUPLICATED, 'd/a', 'e/other')))
+
+    def test_empty_files(self):
+        # Empty files tell nothing about their identity
+        self.assertEqual(classify_unmatched(
+            records(('a', 0, 'e')), records(('b', 0, 'e'))),
+            paths((MISSING, 'a', None), (ADDED, None, 'b')))
+
+
+class FindDuplicatesTest(unittest.TestCase):
+
+    def test_duplicates(self):
+        self.assertEqual(find_duplicates(records(
+            ('c', 1, 'x'), ('a', 1, 'x'), ('b', 2, 'x'), ('e', 0, 'e'),
+            ('f', 0, 'e'))), [['a', 'c']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import io
+import glob
+import hashlib
+import argparse
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+from contextlib import redirect_stdout
+
+from yaml import dump
+
+from sdc_detector.manifest import (FileRecord, iter_tree_records,
+                                   iter_records, iter_manifest, read_header,
+                                   dump_front_coded, make_header)
+from sdc_detector.tree import (DirTreeGeneratorMixed,
+                               DirTreeGeneratorPureDict,
+                               DirTreeGeneratorPureList)
+from sdc_detector.diff import ComparisonMixed
+
+GENERATORS = {
+    'mixed_dict': DirTreeGeneratorMixed,
+    'pure_dict': DirTreeGeneratorPureDict,
+    'pure_list': DirTreeGeneratorPureList,
+}
+# Names that would be read as other types if not quoted, a directory
+# without subdirectories and nested ones
+FILES = {
+    'a': b'a',
+    '123': b'number',
+    'null': b'none',
+    os.path.join('d', 'b'): b'b' * 5000,
+    os.path.join('d', 'e', 'c'): b'c',
+    os.path.join('f', 'yes'): b'g',
+}
+
+
+class Printer:
+    def update(self, _id, data):
+        pass
+
+
+def make_args(**kwargs):
+    args = dict(csum_name='sha1', output_dir='.', compress='none',
+                front_coded=False, reflinks=False, small_file_size=4096,
+                threads=1, exclude=[], include=[], ignore_file='.sdcignore')
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def make_tree(root, files=FILES):
+    """Write files under root, and return their records."""
+    records = []
+    for path, data in files.items():
+        fpath = os.path.join(root, path)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'wb') as fp:
+            fp.write(data)
+        records.append(
+            FileRecord(path, len(data), hashlib.sha1(data).hexdigest()))
+    return sorted(records)
+
+
+class IterRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.root = os.path.join(self.tmp, 'tree')
+        self.records = make_tree(self.root)
+
+    def _generate(self, tree_type, no_output=True):
+        output_dir = os.path.join(self.tmp, tree_type)
+        os.makedirs(output_dir, exist_ok=True)
+        gen = GENERATORS[tree_type](Path(self.root),
+                                    make_args(output_dir=output_dir), Printer())
+        with redirect_stdout(io.StringIO()):
+            return gen.generate(no_output)
+
+    def test_with_header(self):
+        for tree_type in GENERATORS:
+            with self.subTest(tree_type):
+                self._generate(tree_type, no_output=False)
+                fpath, = glob.glob(os.path.join(self.tmp, tree_type, '*.yaml'))
+                self.assertEqual(read_header(fpath)['layout'], tree_type)
+                # The layout is read from the header
+                self.assertEqual(sorted(iter_manifest(fpath)), self.records)
+
+    def test_without_header(self):
+        for tree_type in GENERATORS:
+            with self.subTest(tree_type):
+                tree = self._generate(tree_type)
+                self.assertEqual(sorted(iter_tree_records(tree, tree_type)),
+                                 self.records)
+                stream = io.StringIO(dump(tree))
+                self.assertEqual(sorted(iter_records(stream, tree_type)),
+                                 self.records)
+
+    def test_scalars(self):
+        # Integer checksums (crc32) and quoted names
+        stream = io.StringIO(
+            "--- {sdc_manifest: {version: 1, layout: mixed_dict}}\n"
+            "--- {root: [{'n': '123', 'cs': 5, 'sz': 1},"
+            " {d: [{'n': 'true', 'cs': 'ff', 'sz': 2}]}]}\n")
+        self.assertEqual(list(iter_records(stream)), [
+            FileRecord('123', 1, 5),
+            FileRecord(os.path.join('d', 'true'), 2, 'ff'),
+        ])
+
+    def test_unknown_layout(self):
+        with self.assertRaises(ValueError):
+            list(iter_records(io.StringIO("[]"), 'nope'))
+
+
+class FrontCodedTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        records = [FileRecord(os.path.join(*path.split('/')), size, checksum)
+                   for path, size, checksum in (
+                       ('d/e/f', 1, 'ab'), ('d/e/g', 2, 0), ('d/e2', 3, 'cd'),
+                       ('123', 4, 'ef'), ('a', 5, 'null'))]
+        with tempfile.TemporaryDirectory() as tmp:
+            fpath = os.path.join(tmp, 'manifest.yaml')
+            with open(fpath, 'w') as fp:
+                dump_front_coded(records, fp,
+                                 make_header('front_coded', 'sha1'))
+            self.assertEqual(read_header(fpath)['layout'], 'front_coded')
+            # Written sorted by path
+            self.assertEqual(list(iter_manifest(fpath)), sorted(records))
+
+
+class TreeRecordsTest(unittest.TestCase):
+
+    def test_mixed_unreadable_dir(self):
+        # Directories that can't be read are left as empty placeholders
+        tree = {'root': [{'d': [{}, {'n': 'a', 'sz': 1, 'cs': 'x'}]},
+                         {'n': 'b', 'sz': 2, 'cs': 'y'}]}
+        self.assertEqual(list(iter_tree_records(tree)), [
+            FileRecord(os.path.join('d', 'a'), 1, 'x'),
+            FileRecord('b', 2, 'y'),
+        ])
+
+    def test_compare_mixed_unreadable_dir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for path in ('a', os.path.join('locked', 'b'),
+                         os.path.join('open', 'c')):
+                path = os.path.join(tmp, path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as fp:
+                    fp.write(path)
+            access = os.access
+            with mock.patch('os.access', lambda path, mode: access(path, mode)
+                            and os.path.basename(path) != 'locked'):
+                trees = [DirTreeGeneratorMixed(Path(tmp), make_args(),
+                                               Printer()).generate(True)
+                         for _ in range(2)]
+        self.assertIn({}, trees[0]['root'])
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.assertFalse(ComparisonMixed().compare(*trees))
+        self.assertEqual(out.getvalue(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from sdc_detector.names import NameTable, front_encode
+
+
+class NameTableTest(unittest.TestCase):
+
+    def test_ids(self):
+        names = NameTable()
+        self.assertEqual([names.id(n) for n in ('a', 'b', 'a')], [0, 1, 0])
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names.name(1), 'b')
+        # The first copy of a name is kept
+        first = ''.join(['lo', 'ng'])
+        self.assertIs(names.intern(first), first)
+        self.assertIs(names.intern(''.join(['l', 'ong'])), first)
+
+
+class FrontEncodeTest(unittest.TestCase):
+
+    def test_front_encode(self):
+        self.assertEqual(list(front_encode(['a/b/c', 'a/b/d', 'a/bc', 'b'])),
+                         [(0, 'a/b/c'), (4, 'd'), (3, 'c'), (0, 'b')])
+
+    def test_decode(self):
+        paths = sorted(['d/e/f', 'd/e/g', 'd/e', 'x', 'xy/z', ''])
+        decoded, path = [], ""
+        for shared, suffix in front_encode(paths):
+            path = path[:shared] + suffix
+            decoded.append(path)
+        self.assertEqual(decoded, paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
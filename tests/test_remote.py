@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import tempfile
+import subprocess
+import unittest
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                    '__main__.py')
+TOKEN = 'test-token'
+BLOCK_SIZE = 1 << 16
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+class AgentsTest(unittest.TestCase):
+    """Compare two small trees through two agents on Unix sockets."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._tmp = tempfile.TemporaryDirectory()
+        tmp = cls._tmp.name
+        big = bytes(range(256)) * (3 * BLOCK_SIZE // 256)
+        changed = bytearray(big)
+        changed[BLOCK_SIZE + 10] ^= 0xff  # in the second block only
+        trees = {
+            'a': {'same.txt': b'same', 'big.bin': big,
+                  'sub/moved.txt': b'moved', 'sub/resized.txt': b'short'},
+            'b': {'same.txt': b'same', 'big.bin': bytes(changed),
+                  'other/moved.txt': b'moved', 'sub/resized.txt': b'longer',
+                  'sub/added.txt': b'added'},
+        }
+        cls.env = dict(os.environ, SDC_TOKEN=TOKEN)
+        cls.addresses, cls.agents = [], []
+        for name, files in trees.items():
+            for path, data in files.items():
+                _write(os.path.join(tmp, name, path), data)
+            sock = os.path.join(tmp, name + '.sock')
+            cls.addresses.append('unix://' + sock)
+            cls.agents.append(subprocess.Popen(
+                [sys.executable, MAIN, '--serve', 'unix://' + sock,
+                 os.path.join(tmp, name)], env=cls.env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            deadline = time.monotonic() + 30
+            while not os.path.exists(sock):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Agent for {name} did not start.")
+                time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        for agent in cls.agents:
+            agent.terminate()
+            agent.wait(10)
+        cls._tmp.cleanup()
+
+    def _compare(self, *options):
+        return subprocess.run(
+            [sys.executable, MAIN, *self.addresses, *options], env=self.env,
+            capture_output=True, text=True, timeout=60).stdout
+
+    def _connect(self, address):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address[len('unix://'):])
+        fp = sock.makefile('rwb')
+        self.addCleanup(sock.close)
+        self.addCleanup(fp.close)
+        return fp
+
+    def _request(self, fp, line):
+        fp.write(line + b'\n')
+        fp.flush()
+        return json.loads(fp.readline())
+
+    def test_compare(self):
+        out = self._compare('--block_size', str(BLOCK_SIZE)).splitlines()
+        self.assertTrue(any(line.startswith('big.bin CSUM changed')
+                            for line in out), out)
+        self.assertIn(f"big.bin 1 blocks of {BLOCK_SIZE} bytes differ, "
+                      f"first at offset {BLOCK_SIZE}", out)
+        resized = os.path.join('sub', 'resized.txt')
+        self.assertTrue(any(line.startswith(resized) and 'Size changed from '
+                            '5 to 6' in line for line in out), out)
+        self.assertIn(f"{os.path.join('sub', 'moved.txt')} Moved to "
+                      f"{os.path.join('other', 'moved.txt')}", out)
+        self.assertIn(f"{os.path.join('sub', 'added.txt')} Added", out)
+        self.assertFalse(any('same.txt' in line for line in out), out)
+
+    def test_socket_mode(self):
+        for address in self.addresses:
+            mode = os.stat(address[len('unix://'):]).st_mode
+            self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+    def test_small_blocks_refused(self):
+        out = self._compare('--block_size', '1')
+        self.assertNotIn('blocks of 1 bytes differ', out)
+
+    def test_bad_requests(self):
+        fp = self._connect(self.addresses[0])
+        self.assertIn('error', self._request(fp, b'{"op": "scan"}'))
+        # Connections without the token are closed
+        self.assertEqual(fp.readline(), b'')
+
+        fp = self._connect(self.addresses[0])
+        hello = json.dumps({'op': 'hello', 'token': TOKEN}).encode()
+        self.assertEqual(self._request(fp, hello), {})
+        for line in (b'not json', b'[1]', b'{"op": "aggregate"}',
+                     b'{"op": "records", "path": 1}',
+                     b'{"op": "blocks", "path": "big.bin", "block_size": 1}',
+                     b'{"op": "blocks", "path": "nope", "block_size": 65536}',
+                     b'{"op": "filter", "filters": ["re:("]}'):
+            self.assertIn('error', self._request(fp, line), line)
+        # The agent still answers on the same connection
+        self.assertEqual(self._request(fp, b'{"op": "scan"}')['files'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import argparse
+import tempfile
+import unittest
+
+from sdc_detector.watch import TreeWatcher
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "inotify only")
+class ScrubTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = os.path.join(tmp.name, 'tree')
+        os.mkdir(self.root)
+        self.path = os.path.join(self.root, 'f')
+        with open(self.path, 'w') as fp:
+            fp.write('data')
+        args = argparse.Namespace(csum_name='sha1', interval=1, scrub=10,
+            compress='none', exclude=[], include=[], ignore_file='.sdcignore',
+            output_dir=tmp.name)
+        self.watcher = TreeWatcher(self.root, args)
+        self.addCleanup(self.watcher._inotify.close)
+
+    def _corrupt(self, data):
+        """Change the file behind the back of the watcher."""
+        st = os.stat(self.path)
+        with open(self.path, 'w') as fp:
+            fp.write(data)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.watcher._read_events(0)
+        self.watcher.dirty.clear()
+
+    def test_reported_once(self):
+        self._corrupt('bad!')
+        with self.assertLogs(level='CRITICAL'):
+            self.watcher.scrub()
+        with self.assertNoLogs(level='CRITICAL'):
+            self.watcher.scrub()
+        # Reported again when it changes again
+        self._corrupt('worse')
+        with self.assertLogs(level='CRITICAL'):
+            self.watcher.scrub()
+
+    def test_lost_events(self):
+        self._corrupt('bad!')
+        self.watcher._rescan()
+        self.assertEqual(self.watcher.dirty, set())
+        with self.assertLogs(level='CRITICAL'):
+            self.watcher.scrub()
+
+
+if __name__ == '__main__':
+    unittest.main()